@@ -0,0 +1,79 @@
+import argparse
+import re
+import time
+
+from ipyslurm import tracker, util
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing of scontrol show job output for large job arrays.')
+    parser.add_argument('tasks', nargs='?', type=int, default=50000, help='number of array tasks')
+    parser.add_argument('--repeat', type=int, default=3, help='number of repetitions')
+    args = parser.parse_args()
+
+    blocks = list(synthetic_output(args.tasks))
+    multiline = [y for x in blocks for y in x + ['']]
+    oneliner = [' '.join(x.strip() for x in y) for y in blocks]
+    for name, function, stdouts in (
+            ('split (--details)', parse_split, multiline),
+            ('JobTable (--details)', tracker.JobTable.from_scontrol, multiline),
+            ('JobTable (--details --oneliner)', tracker.JobTable.from_scontrol, oneliner),
+            ('scontrol_show_job (--details --oneliner)', parse_public, oneliner)):
+        elapsed = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            details = function(stdouts)
+            for field in ('JobId', 'JobName', 'JobState', 'ArrayTaskId', 'StdOut'):
+                [x[field] for x in details]
+            elapsed.append(time.perf_counter() - start)
+        print(f'{name:>42}: {min(elapsed):.3f} s for {len(details)} tasks')
+
+
+def parse_public(stdouts):
+    """Parse records into dictionaries as Slurm.scontrol_show_job does."""
+    return tracker.JobTable.from_scontrol(stdouts).dicts()
+
+
+def parse_split(stdouts):
+    """Parse records as ipyslurm 2.3 did, for reference."""
+    details = util.split_list(stdouts, separator='')[:-1]
+    details = [re.split(r'\s*(\w+)=', ' '.join(x)) for x in details]
+    details = [dict([x[i:i+2] for i in range(1, len(x), 2)]) for x in details]
+    return sorted(details, key=lambda x: int(x['ArrayTaskId']) if 'ArrayTaskId' in x and x['ArrayTaskId'].isnumeric() else 0)
+
+
+def synthetic_output(tasks, jobid=1000000):
+    for i in reversed(range(tasks)):
+        yield [
+            f'JobId={jobid + i + 1} ArrayJobId={jobid} ArrayTaskId={i} JobName=synthetic',
+            '   UserId=user(1000) GroupId=user(1000) MCS_label=N/A',
+            '   Priority=4294901759 Nice=0 Account=lab QOS=normal',
+            f'   JobState={"RUNNING" if i % 3 else "PENDING"} Reason=None Dependency=(null)',  # noqa: Q000
+            '   Requeue=1 Restarts=0 BatchFlag=1 Reboot=0 ExitCode=0:0',
+            '   DerivedExitCode=0:0',
+            '   RunTime=00:10:00 TimeLimit=1-00:00:00 TimeMin=N/A',
+            '   SubmitTime=2024-01-01T00:00:00 EligibleTime=2024-01-01T00:00:00',
+            '   AccrueTime=2024-01-01T00:00:00',
+            '   StartTime=2024-01-01T00:00:10 EndTime=2024-01-02T00:00:10 Deadline=N/A',
+            '   SuspendTime=None SecsPreSuspend=0 LastSchedEval=2024-01-01T00:00:10',
+            '   Partition=debug AllocNode:Sid=login01:12345',
+            '   ReqNodeList=(null) ExcNodeList=(null)',
+            f'   NodeList=node{i % 100:03d}',
+            f'   BatchHost=node{i % 100:03d}',
+            '   NumNodes=1 NumCPUs=4 NumTasks=1 CPUs/Task=4 ReqB:S:C:T=0:0:*:*',
+            '   TRES=cpu=4,mem=16G,node=1,billing=4',
+            '   Socks/Node=* NtasksPerN:B:S:C=0:0:*:* CoreSpec=*',
+            f'     Nodes=node{i % 100:03d} CPU_IDs=0-3 Mem=16384 GRES=',
+            '   MinCPUsNode=4 MinMemoryNode=16G MinTmpDiskNode=0',
+            '   Features=(null) DelayBoot=00:00:00',
+            '   OverSubscribe=OK Contiguous=0 Licenses=(null) Network=(null)',
+            '   Command=/home/user/job.sh',
+            '   WorkDir=/home/user',
+            f'   StdErr=/home/user/slurm-{jobid}_{i}.out',
+            '   StdIn=/dev/null',
+            f'   StdOut=/home/user/slurm-{jobid}_{i}.out',
+            '   Power=']
+
+
+if __name__ == '__main__':
+    main()
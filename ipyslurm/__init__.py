@@ -1,5 +1,7 @@
 from .version import __version__  # noqa: F401
 from .slurm import Slurm  # noqa: F401, I100
+from .aio import AsyncSlurm  # noqa: F401, I100
+from .group import SlurmGroup  # noqa: F401, I100
 
 try:
     from .magic import SlurmMagics
@@ -0,0 +1,107 @@
+import asyncio
+import functools
+
+from IPython.display import clear_output
+
+from . import ssh
+from . import stats as metrics
+from .slurm import Slurm
+
+POLL_INTERVAL = 0.05
+
+
+class AsyncSlurm:
+    """Asynchronous interface to Slurm for use from a running event loop, e.g., that of a notebook.
+
+    Shares the connection of the wrapped Slurm instance.
+    Remote commands run on their own channel, which is closed when the awaiting task is cancelled.
+    Other operations run in the default executor, where cancellation takes effect once the current round trip completes.
+    """
+
+    def __init__(self, slurm=None):
+        self.slurm = Slurm() if slurm is None else slurm
+
+    async def command(self, lines):
+        self.slurm._verify_login()
+        with metrics.timer('command'):
+            command = await self._run(self.slurm._command, lines)  # may upload scripts
+            return '\n'.join(await self._exec_command('\n'.join(command)))
+
+    async def history(self, sync=True, **kwargs):
+        return await self._run(self.slurm.history, sync, **kwargs)
+
+    async def jobs(self, job=None, refresh=False):
+        return await self._run(self.slurm.jobs, job, refresh)
+
+    async def login(self, server, username, password=None, **kwargs):
+        await self._run(self.slurm.login, server, username, password, **kwargs)
+
+    async def logout(self):
+        await self._run(self.slurm.logout)
+
+    async def sbatch(self, lines, args=None):
+        return await self._run(self.slurm.sbatch, lines, args)
+
+    async def sbatch_many(self, scripts, args=None, error=True):
+        return await self._run(self.slurm.sbatch_many, scripts, args, error)
+
+    async def scontrol_show_job(self, job):
+        return await self._run(self.slurm.scontrol_show_job, job)
+
+    async def sftp(self, lines, workers=1):
+        await self._run(self.slurm.sftp, lines, workers)
+
+    async def tail(self, job, lines=1, repeat=True, clear=True, interval=1):
+        while True:
+            output, active = await self._run(self.slurm._tail, job, lines)
+            if lines is not None:
+                if clear:
+                    clear_output(wait=True)
+                print(output, end='', flush=True)
+            if not repeat or not active:
+                break
+            await asyncio.sleep(interval)
+
+    async def _exec_command(self, command, error=True):
+        channel = await self._run(self._open_channel, command)
+        stdout, stderr = b'', b''
+        interval = 0.001
+        try:
+            while True:
+                received = False
+                while channel.recv_ready():
+                    stdout += channel.recv(32768)
+                    received = True
+                while channel.recv_stderr_ready():
+                    stderr += channel.recv_stderr(32768)
+                    received = True
+                if channel.eof_received and channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+                interval = 0.001 if received else min(2 * interval, POLL_INTERVAL)
+                await asyncio.sleep(interval)
+        finally:
+            channel.close()
+        metrics.count('bytes_received', len(stdout) + len(stderr))
+        status = channel.recv_exit_status()
+        stdouts, stderrs = _lines(stdout), _lines(stderr)
+        if error and status > 0:
+            raise ssh.command_error(command, status, stdouts, stderrs)
+        return stdouts or stderrs
+
+    def _open_channel(self, command):
+        self.slurm.ssh.reconnect()
+        channel = self.slurm.ssh.get_transport().open_session()
+        channel.exec_command(command)
+        metrics.count('commands')
+        metrics.count('exec_channels')
+        if metrics.enabled:
+            metrics.count('bytes_sent', len(command.encode()))
+        return channel
+
+    async def _run(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+
+def _lines(data):
+    lines = data.decode(errors='replace').split('\n')
+    return lines[:-1] if lines[-1] == '' else lines
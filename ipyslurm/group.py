@@ -0,0 +1,90 @@
+import logging
+import queue
+import threading
+from concurrent import futures
+
+
+class SlurmGroup:
+    """Slurm instances on several clusters, running commands on all of them concurrently.
+
+    Results are merged and tagged by the name of each cluster, and submissions are routed to the cluster with the fewest pending jobs unless specified.
+    """
+
+    def __init__(self, members):
+        if not isinstance(members, dict):
+            members = {x.server: x for x in members}
+        self.members = members
+
+    def command(self, lines, stream=False):
+        if stream:
+            return self._stream(lines)
+        outputs = self._map(lambda x: x.command(lines))
+        return '\n'.join(f'{name}: {x}' for name, output in outputs.items() for x in output.splitlines())
+
+    def jobs(self, job=None, refresh=False):
+        return [dict(x, Cluster=name) for name, records in self._map(lambda x: x.jobs(job, refresh)).items() for x in records]
+
+    def pending(self):
+        """Return the number of pending jobs, counting array tasks, on each cluster."""
+        return {name: int(x) for name, x in self._map(lambda x: x.command('squeue --noheader --array --states=PENDING --format=%i | wc -l')).items()}
+
+    def sbatch(self, lines, args=None, cluster=None):
+        """Submit a batch script to a cluster, by default the one with the fewest pending jobs, and return (cluster, job ID)."""
+        if cluster is None:
+            pending = self.pending()
+            cluster = min(pending, key=pending.get)
+            logging.getLogger('ipyslurm.group').debug(f'Submitting to {cluster} with {pending[cluster]} pending jobs')
+        return cluster, self.members[cluster].sbatch(lines, args)
+
+    def scontrol_show_job(self, job):
+        """Return details of a job from the clusters that know it, tagged with their names."""
+        details = self._map(lambda x: x.scontrol_show_job(job), error=False)
+        found = {name: x for name, x in details.items() if not isinstance(x, Exception)}
+        if not found:
+            raise RuntimeError(f'Job {job} was not found on any cluster:\n' + '\n'.join(f'{name}: {x}' for name, x in details.items()))
+        return [dict(y, Cluster=name) for name, x in found.items() for y in x]
+
+    def squeue(self, output_format=None):
+        outputs = self._map(lambda x: x.command(f'squeue --format "{output_format or "%.20j %.15i %.7M %.10l %.7u %.9P %.8T %R"}"'))  # noqa: Q000
+        width = max(len(x) for x in ['CLUSTER', *outputs])
+        lines = []
+        for name, output in outputs.items():
+            header, *rows = output.splitlines() or ['']
+            if not lines:
+                lines.append(f'{"CLUSTER":>{width}} {header}')  # noqa: Q000
+            lines += [f'{name:>{width}} {x}' for x in rows]
+        print('\n'.join(lines))
+
+    def _map(self, function, error=True):
+        with futures.ThreadPoolExecutor(len(self.members)) as executor:
+            tasks = {name: executor.submit(function, x) for name, x in self.members.items()}
+        results = {}
+        for name, task in tasks.items():
+            if task.exception() is not None and error:
+                raise RuntimeError(f'Failed on {name}: {task.exception()}') from task.exception()
+            results[name] = task.exception() or task.result()
+        return results
+
+    def _stream(self, lines):
+        lines_, sentinel = queue.SimpleQueue(), object()
+
+        def read(name, slurm):
+            try:
+                for line in slurm.command(lines, stream=True):
+                    lines_.put(f'{name}: {line}')
+            except Exception as e:
+                lines_.put(e)
+            finally:
+                lines_.put(sentinel)
+
+        for name, slurm in self.members.items():
+            threading.Thread(target=read, args=(name, slurm), daemon=True).start()
+        remaining = len(self.members)
+        while remaining:
+            line = lines_.get()
+            if line is sentinel:
+                remaining -= 1
+            elif isinstance(line, Exception):
+                raise line
+            else:
+                yield line
@@ -0,0 +1,141 @@
+import logging
+import os
+import sqlite3
+import threading
+import weakref
+
+from .util import parse_size
+
+FIELDS = (
+    'JobIDRaw',
+    'JobID',
+    'User',
+    'Partition',
+    'State',
+    'ExitCode',
+    'Submit',
+    'Start',
+    'End',
+    'ElapsedRaw',
+    'AllocCPUS',
+    'ReqMem',
+    'MaxRSS',
+    'NodeList',
+    'JobName')
+FINISHED_STATES = 'BF,CA,CD,DL,F,NF,OOM,PR,TO'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    JobIDRaw TEXT PRIMARY KEY,
+    JobID TEXT,
+    ArrayJobID TEXT,
+    ArrayTaskID TEXT,
+    JobName TEXT,
+    User TEXT,
+    Partition TEXT,
+    State TEXT,
+    ExitCode TEXT,
+    Submit TEXT,
+    Start TEXT,
+    End TEXT,
+    ElapsedRaw INTEGER,
+    AllocCPUS INTEGER,
+    ReqMem TEXT,
+    MaxRSS INTEGER,
+    NodeList TEXT);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (State);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (User);
+CREATE INDEX IF NOT EXISTS jobs_partition ON jobs (Partition);
+CREATE INDEX IF NOT EXISTS jobs_array ON jobs (ArrayJobID);
+CREATE INDEX IF NOT EXISTS jobs_end ON jobs (End);
+"""
+
+
+class JobHistory:
+    """Local SQLite store of finished jobs, synchronized incrementally from sacct.
+
+    Each synchronization only requests jobs that ended since the latest end time in the store, and MaxRSS is the maximum over the steps of a job.
+    """
+
+    def __init__(self, slurm, path=None, since='now-30days', all_users=False):
+        if path is None:
+            transport = slurm.ssh.get_transport()
+            path = os.path.join(os.path.expanduser('~'), '.cache', 'ipyslurm', 'history', f'{"all" if all_users else transport.get_username()}@{slurm.server}.sqlite')  # noqa: PL118
+            os.makedirs(os.path.dirname(path), exist_ok=True)  # noqa: PL103
+        self.all_users = all_users
+        self.path = path
+        self.since = since
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._slurm = weakref.ref(slurm)  # like JobTracker, so that Slurm._history does not form a cycle
+
+    def __del__(self):
+        self._connection.close()
+
+    def query(self, state=None, user=None, partition=None, array=None, after=None, before=None):
+        """Return stored jobs as dictionaries ordered by end time, filtered by state(s), user, partition, array job ID and end time (ISO 8601)."""
+        conditions, parameters = [], []
+        for column, value in (('State', state), ('User', user), ('Partition', partition), ('ArrayJobID', array)):
+            if value is not None:
+                values = [value] if isinstance(value, (str, int)) else list(value)
+                conditions.append(f'{column} IN ({", ".join("?" * len(values))})')
+                parameters += [str(x) for x in values]
+        if after is not None:
+            conditions.append('End >= ?')
+            parameters.append(after)
+        if before is not None:
+            conditions.append('End < ?')
+            parameters.append(before)
+        with self._lock:
+            rows = self._connection.execute(f'SELECT * FROM jobs {"WHERE " + " AND ".join(conditions) if conditions else ""} ORDER BY End', parameters).fetchall()
+        return [dict(x) for x in rows]
+
+    @property
+    def slurm(self):
+        return self._slurm()
+
+    def sync(self):
+        """Request jobs that ended since the last synchronization and store them, returning their number."""
+        with self._lock:
+            end = self._connection.execute('SELECT MAX(End) FROM jobs').fetchone()[0]
+            stdouts = self.slurm.ssh.exec_command(f"sacct --parsable2 --noheader {'--allusers ' if self.all_users else ''}--state={FINISHED_STATES} --starttime={end or self.since} --endtime=now --format={','.join(FIELDS)}")
+            jobs, steps = {}, {}
+            for stdout in stdouts:
+                fields = stdout.split('|', len(FIELDS) - 1)
+                if len(fields) != len(FIELDS):
+                    continue
+                record = dict(zip(FIELDS, fields))
+                try:
+                    maxrss = parse_size(record['MaxRSS']) if record['MaxRSS'] else None
+                except ValueError:
+                    maxrss = None
+                jobid, _, step = record['JobIDRaw'].partition('.')
+                if step:
+                    if maxrss is not None:
+                        steps[jobid] = max(steps.get(jobid, 0), maxrss)
+                    continue
+                arrayjobid, _, arraytaskid = record['JobID'].partition('_')
+                jobs[jobid] = (
+                    jobid,
+                    record['JobID'],
+                    arrayjobid if arraytaskid else None,
+                    arraytaskid or None,
+                    record['JobName'],
+                    record['User'],
+                    record['Partition'],
+                    record['State'].split()[0] if record['State'] else None,
+                    record['ExitCode'],
+                    record['Submit'],
+                    record['Start'],
+                    record['End'],
+                    int(record['ElapsedRaw']) if record['ElapsedRaw'].isnumeric() else None,
+                    int(record['AllocCPUS']) if record['AllocCPUS'].isnumeric() else None,
+                    record['ReqMem'],
+                    maxrss,
+                    record['NodeList'])
+            rows = [x[:15] + (max(x[15] or 0, steps.get(x[0], 0)) or None,) + x[16:] for x in jobs.values()]
+            with self._connection:
+                self._connection.executemany(f'INSERT OR REPLACE INTO jobs VALUES ({", ".join("?" * 17)})', rows)
+        logging.getLogger('ipyslurm.history').debug(f'Synchronized {len(rows)} jobs that ended since {end or self.since}')
+        return len(rows)
@@ -4,7 +4,8 @@ import timeit
 from IPython.core import magic, magic_arguments
 from IPython.display import clear_output
 
-from . import slurm
+from . import group, monitor, slurm
+from . import stats as metrics
 
 
 @magic.magics_class
@@ -18,34 +19,70 @@ class SlurmMagics(magic.Magics):
     @magic_arguments.argument('--args', nargs='*', help='Additional arguments to sbatch')
     @magic_arguments.argument('--job', help='Store job ID in variable', metavar='VARIABLE')
     @magic_arguments.argument('--instance', help='Existing slurm instance', metavar='VARIABLE')
+    @magic_arguments.argument('--instances', help='Existing slurm instances, submitting to the one with the fewest pending jobs', metavar='VARIABLE,...')
     @magic.needs_local_scope
     @magic.cell_magic
     def sbatch(self, line, cell, local_ns):
         """Submit a batch script to Slurm."""
         args = magic_arguments.parse_argstring(self.sbatch, line)
-        slurm = local_ns.get(args.instance, self._slurm)
+        slurm = self._instance(args, local_ns)
         job = slurm.sbatch(cell, args.args)
-        print(f'Submitted batch job {job}')
+        if isinstance(job, tuple):
+            print(f'Submitted batch job {job[1]} on {job[0]}')
+        else:
+            print(f'Submitted batch job {job}')
         if args.job is not None:
             local_ns.update({args.job: job})
 
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument('job', help='Job ID')
+    @magic_arguments.argument('destination', nargs='?', default='.', help='Local directory to download outputs to')
+    @magic_arguments.argument('--workers', default=8, type=int, help='Number of SFTP sessions used for downloads', metavar='N')
+    @magic_arguments.argument('--no-wait', action='store_true', help='Collect outputs of completed tasks only, without waiting for the rest')
+    @magic_arguments.argument('--interval', default=10, type=float, help='Polling interval while waiting for tasks to complete', metavar='SECONDS')
+    @magic_arguments.argument('--instance', help='Existing slurm instance', metavar='VARIABLE')
+    @magic.needs_local_scope
+    @magic.line_magic
+    def scollect(self, line, local_ns):
+        """Download output of job tasks as they complete."""
+        args = magic_arguments.parse_argstring(self.scollect, line)
+        slurm = local_ns.get(args.instance, self._slurm)
+        slurm.collect(args.job, args.destination, workers=args.workers, wait=not args.no_wait, interval=args.interval)
+
     @magic_arguments.magic_arguments()
     @magic_arguments.argument('--period', type=float, help='Repeat execution with a given periodicity', metavar='SECONDS')
     @magic_arguments.argument('--timeout', type=float, help='Timeout for when used with --period', metavar='SECONDS')
+    @magic_arguments.argument('--stream', action='store_true', help='Print output incrementally as it arrives')
+    @magic_arguments.argument('--background', action='store_true', help='Repeat execution on a worker thread with --period, updating the output only when it changes')
     @magic_arguments.argument('--stdout', help='Store stdout in variable', metavar='VARIABLE')
     @magic_arguments.argument('--instance', help='Existing slurm instance', metavar='VARIABLE')
+    @magic_arguments.argument('--instances', help='Existing slurm instances to execute commands on concurrently', metavar='VARIABLE,...')
     @magic.needs_local_scope
     @magic.cell_magic
     def scommand(self, line, cell, local_ns):
         """Execute commands on server."""
         args = magic_arguments.parse_argstring(self.scommand, line)
-        slurm = local_ns.get(args.instance, self._slurm)
+        slurm = self._instance(args, local_ns)
+        if args.background:
+            if args.stdout or args.stream:
+                raise ValueError('--stdout and --stream are not supported with --background')
+            task = monitor.start('scommand', lambda: (slurm.command(cell), True), args.period or 10, timeout=args.timeout)
+            print(f'Started monitor {task.name}')
+            return
         start = timeit.default_timer()
         try:
             while True:
-                stdout = slurm.command(cell)
-                clear_output(wait=True)
-                print(stdout)
+                if args.stream:
+                    clear_output(wait=True)
+                    stdout = []
+                    for line_ in slurm.command(cell, stream=True):
+                        print(line_, flush=True)
+                        stdout.append(line_)
+                    stdout = '\n'.join(stdout)
+                else:
+                    stdout = slurm.command(cell)
+                    clear_output(wait=True)
+                    print(stdout)
                 elapsed = timeit.default_timer() - start
                 if args.timeout is not None and elapsed > args.timeout:
                     print(f'Timed out after {elapsed:.1f} seconds')
@@ -59,18 +96,26 @@ class SlurmMagics(magic.Magics):
             local_ns.update({args.stdout: stdout})
 
     @magic_arguments.magic_arguments()
+    @magic_arguments.argument('--workers', default=1, type=int, help='Number of SFTP sessions used for recursive transfers', metavar='N')
+    @magic_arguments.argument('--profile', help='Tuning profile for this transfer, one of auto, default, lan, vpn, wan')
+    @magic_arguments.argument('--limit', help='Bandwidth limit for this transfer in bytes per second, e.g., 50M', metavar='RATE')
     @magic_arguments.argument('--instance', help='Existing slurm instance', metavar='VARIABLE')
     @magic.needs_local_scope
     @magic.cell_magic
     def sftp(self, line, cell, local_ns):
         """File transfer over secure shell.
 
-        Supported commands: cd, chmod, chown, get, lcd, lls, lmkdir, ln, lpwd, lrm, lrmdir, ls, mkdir, put, pwd, rename, rm, rmdir, symlink.
+        Supported commands: cd, chmod, chown, get, lcd, lls, lmkdir, ln, lpwd, lrm, lrmdir, ls, mkdir, put, pwd, rename, rm, rmdir, symlink, sync.
         See https://man.openbsd.org/sftp#INTERACTIVE_COMMANDS for details.
+        get and put accept -j N to transfer files (or byte ranges of large files) over N parallel sessions.
+        With -a, partial transfers are continued from the size of the destination, verifying its tail with -c.
+        With -v (--verify), digests of the transferred files are compared against sha256sum of the remote files.
+        With -rt, directories are streamed as a single tar archive (gzip compressed with -z), which is faster for many small files.
+        sync [-cd] [-j N] get|put source [destination] transfers only changed files, comparing content hashes with -c and deleting extraneous files with -d.
         """
         args = magic_arguments.parse_argstring(self.sftp, line)
         slurm = local_ns.get(args.instance, self._slurm)
-        slurm.sftp(cell)
+        slurm.sftp(cell, workers=args.workers, profile=args.profile, limit=args.limit)
 
     @magic_arguments.magic_arguments()
     @magic_arguments.argument('--instance', help='Existing slurm instance', metavar='VARIABLE')
@@ -86,11 +131,14 @@ class SlurmMagics(magic.Magics):
     @magic_arguments.argument('--server', help='Address of server', metavar='ADDRESS')
     @magic_arguments.argument('--username', help='Username, interactively requested if not provided')
     @magic_arguments.argument('--password', help='Password, interactively requested if not provided')
+    @magic_arguments.argument('--persistent', action='store_true', help='Execute commands in a long-lived remote shell')
+    @magic_arguments.argument('--profile', default='auto', help='Tuning profile, one of auto, default, lan, vpn, wan')
+    @magic_arguments.argument('--limit', help='Bandwidth limit of transfers in bytes per second, e.g., 50M', metavar='RATE')
     @magic.line_magic
     def slogin(self, line):
         """Login to server."""
         args = magic_arguments.parse_argstring(self.slogin, line)
-        self._slurm.login(args.server, args.username, args.password)
+        self._slurm.login(args.server, args.username, args.password, persistent=args.persistent, profile=args.profile, limit=args.limit)
 
     @magic_arguments.magic_arguments()
     @magic.line_magic
@@ -99,17 +147,68 @@ class SlurmMagics(magic.Magics):
         magic_arguments.parse_argstring(self.slogout, line)
         self._slurm.logout()
 
+    @magic_arguments.magic_arguments()
+    @magic.line_magic
+    def smonitors(self, line):
+        """List background monitors."""
+        magic_arguments.parse_argstring(self.smonitors, line)
+        now = time.monotonic()
+        for task in monitor.monitors():
+            status = 'failed' if task.error is not None else 'running' if task.running else 'done'
+            updated = f'updated {now - task.updated:.0f}s ago' if task.updated is not None else 'not updated'
+            print(f'{task.name}: {status}, started {now - task.started:.0f}s ago, {updated}')
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument('--enable', action='store_true', help='Start collecting statistics')
+    @magic_arguments.argument('--disable', action='store_true', help='Stop collecting statistics')
+    @magic_arguments.argument('--reset', action='store_true', help='Clear statistics after printing them')
+    @magic.line_magic
+    def sstats(self, line):
+        """Print counters of round trips and bytes, and latencies of operations."""
+        args = magic_arguments.parse_argstring(self.sstats, line)
+        if args.enable:
+            metrics.enable()
+        if args.disable:
+            metrics.disable()
+        snapshot = self._slurm.stats(reset=args.reset)
+        if not snapshot['enabled']:
+            print('Statistics are disabled, use --enable to start collecting them')
+        for name, value in snapshot['counters'].items():
+            print(f'{name:<20} {value:>12}')
+        if snapshot['latency']:
+            print(f'{"latency (ms)":<20} {"count":>8} {"mean":>10} {"p50":>10} {"p95":>10} {"max":>10}')  # noqa: Q000
+        for name, x in snapshot['latency'].items():
+            print(f'{name:<20} {x["count"]:>8} {1000 * x["mean"]:>10.1f} {1000 * x["p50"]:>10.1f} {1000 * x["p95"]:>10.1f} {1000 * x["max"]:>10.1f}')  # noqa: Q000
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument('names', nargs='*', help='Names of monitors, all if not provided')
+    @magic.line_magic
+    def sstop(self, line):
+        """Stop background monitors."""
+        args = magic_arguments.parse_argstring(self.sstop, line)
+        for task in monitor.stop(args.names):
+            print(f'Stopped monitor {task.name}')
+
     @magic_arguments.magic_arguments()
     @magic_arguments.argument('job', help='Job ID')
     @magic_arguments.argument('--lines', default=1, type=int, help='Print last N lines of the log', metavar='N')
+    @magic_arguments.argument('--follow', action='store_true', help='Print new lines as they are appended to the log')
+    @magic_arguments.argument('--interval', default=1, type=float, help='Initial polling interval, doubled while there is no new output', metavar='SECONDS')
+    @magic_arguments.argument('--background', action='store_true', help='Poll on a worker thread, updating the output only when it changes')
     @magic_arguments.argument('--instance', help='Existing slurm instance', metavar='VARIABLE')
     @magic.needs_local_scope
     @magic.line_magic
     def stail(self, line, local_ns):
-        """Logout of server."""
+        """Print output of jobs."""
         args = magic_arguments.parse_argstring(self.stail, line)
         slurm = local_ns.get(args.instance, self._slurm)
-        slurm.tail(args.job, lines=args.lines)
+        if args.background:
+            if args.follow:
+                raise ValueError('--follow is not supported with --background')
+            task = monitor.start('stail', lambda: slurm._tail(args.job, args.lines), args.interval, max_interval=30)
+            print(f'Started monitor {task.name}')
+            return
+        slurm.tail(args.job, lines=args.lines, follow=args.follow, interval=args.interval)
 
     @magic_arguments.magic_arguments()
     @magic_arguments.argument('filepath', help='Path of file')
@@ -121,3 +220,8 @@ class SlurmMagics(magic.Magics):
         args = magic_arguments.parse_argstring(self.swritefile, line)
         slurm = local_ns.get(args.instance, self._slurm)
         slurm.writefile(args.filepath, cell, append=args.append)
+
+    def _instance(self, args, local_ns):
+        if getattr(args, 'instances', None):
+            return group.SlurmGroup({x: local_ns[x] for x in args.instances.split(',')})
+        return local_ns.get(args.instance, self._slurm)
@@ -0,0 +1,113 @@
+import itertools
+import logging
+import threading
+import time
+
+from IPython.display import display, Pretty
+
+_count = itertools.count(1)
+_monitors = {}
+_monitors_lock = threading.Lock()
+
+
+def monitors():
+    """Return monitors in the order they were started."""
+    with _monitors_lock:
+        return list(_monitors.values())
+
+
+def start(kind, poll, interval, max_interval=None, timeout=None):
+    """Start a monitor with a unique name derived from kind, see Monitor."""
+    with _monitors_lock:
+        name = f'{kind}-{next(_count)}'
+        monitor = _monitors[name] = Monitor(name, poll, interval, max_interval, timeout)
+    monitor.start()
+    return monitor
+
+
+def stop(names=None):
+    """Stop and forget monitors by name, or all monitors if no names are given, and return them."""
+    with _monitors_lock:
+        if names:
+            missing = [x for x in names if x not in _monitors]
+            if missing:
+                raise KeyError(f'Unknown monitors: {", ".join(missing)}')  # noqa: Q000
+        stopped = [_monitors.pop(x) for x in list(_monitors) if not names or x in names]
+    for monitor in stopped:
+        monitor.stop()
+    return stopped
+
+
+class Monitor:
+    """Poll on a worker thread and update a display only when the output changes.
+
+    poll returns (output, active) and is repeated every interval seconds, doubling up to max_interval while the output is unchanged, until it is inactive, timeout is reached or the monitor is stopped.
+    Output that extends the previous output is appended to an ipywidgets.Output, so that only the difference is sent, otherwise the display is replaced.
+    """
+
+    def __init__(self, name, poll, interval, max_interval=None, timeout=None):
+        self.error = None
+        self.interval = interval
+        self.max_interval = interval if max_interval is None else max_interval
+        self.name = name
+        self.poll = poll
+        self.started = None
+        self.timeout = timeout
+        self.updated = None
+        self._output = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'ipyslurm-{name}', daemon=True)
+        try:
+            import ipywidgets
+        except ModuleNotFoundError:
+            self._handle, self._widget = display(Pretty(f'{name}: starting'), display_id=True), None
+        else:
+            self._handle, self._widget = None, ipywidgets.Output()
+            display(self._widget)
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def start(self):
+        self.started = time.monotonic()
+        self._thread.start()
+
+    def stop(self, timeout=0):
+        """Signal the worker thread to stop, which takes effect once a poll in flight completes, waiting up to timeout seconds for it."""
+        self._stopped.set()
+        if timeout and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def _render(self, output):
+        previous, self._output = self._output, output
+        if self._widget is None:
+            self._handle.update(Pretty(output))
+        elif previous and output.startswith(previous):
+            self._widget.append_stdout(output[len(previous):])
+        else:
+            self._widget.outputs = ()
+            self._widget.append_stdout(output)
+
+    def _run(self):
+        delay = self.interval
+        while not self._stopped.is_set():
+            try:
+                output, active = self.poll()
+                if self._stopped.is_set():
+                    break
+            except Exception as e:
+                logging.getLogger('ipyslurm.monitor').debug(f'Monitor {self.name} failed: {e}')
+                self.error = e
+                self._render(f'{self._output or ""}\n{self.name}: {e}\n'.lstrip('\n'))  # noqa: Q000
+                break
+            if output != self._output:
+                self._render(output)
+                self.updated = time.monotonic()
+                delay = self.interval
+            else:
+                delay = min(2 * delay, self.max_interval)
+            if not active or (self.timeout is not None and time.monotonic() - self.started + delay > self.timeout):
+                break
+            self._stopped.wait(delay)
+        self._stopped.set()
@@ -1,21 +1,48 @@
-import datetime
+import collections
+import contextlib
+import functools
+import hashlib
 import importlib
+import io
 import logging
 import os
 import pathlib
+import posixpath
+import re
 import shlex
 import stat
+import tarfile
+import threading
+import time
+import uuid
+from concurrent import futures
 
+import paramiko
 from tqdm import tqdm
 
-from .util import sort_key_natural
+from . import stats as metrics
+from .ssh import Tuning
+from .util import parse_argv, sort_key_natural, split_list
 
+BLOCK_SIZE = 2 ** 20
+CACHE_DIRECTORY = '.cache/ipyslurm'
+CHUNK_SIZE = 32768
+COMMAND_SIZE = 2 ** 16
 PBAR_FORMAT = '{desc}: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}{postfix}]'
+PBAR_FORMAT_BYTES = '{desc}: {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
 PBAR_FUNCTIONS = (
     'get',
     'lrm',
     'put',
-    'rm')
+    'rm',
+    'sync')
+LOCAL_FUNCTIONS = (
+    'lcd',
+    'lls',
+    'lmkdir',
+    'lpwd',
+    'lrm',
+    'lrmdir')
 SFTP_FUNCTIONS = {
     'cd': 'chdir',
     'chmod': 'chmod',
@@ -35,19 +62,57 @@ SFTP_FUNCTIONS = {
     'rename': 'rename',
     'rm': 'remove',
     'rmdir': 'rmdir',
-    'symlink': 'symlink'}
+    'symlink': 'symlink',
+    'sync': 'sync'}
+RANGE_SIZE = 2 ** 26
+READAHEAD_SIZE = 2 ** 23
+TAIL_SIZE = 2 ** 20
+UPLOAD_WORKERS = 8
+
+
+def pbar_bytes(pbar, total):
+    """Switch a progress bar to report transferred bytes and throughput."""
+    pbar.bar_format = PBAR_FORMAT_BYTES
+    pbar.unit, pbar.unit_scale, pbar.unit_divisor = 'B', True, 1024
+    pbar.reset(total)
 
 
 class SFTP:
 
-    def __init__(self, ssh):
+    def __init__(self, ssh, workers=1, tuning=None):
         self.ssh = ssh
-        self.ftp = self.ssh.open_sftp()
+        self.tuning = (Tuning() if tuning is None else tuning).measure(ssh)
+        self.ftp = self.ssh.open_sftp(self.tuning.window_size, self.tuning.max_packet_size)
+        self.home = self.ftp.normalize('.')
+        self.workers = workers
+        self._directories = set()
+        self._exec = True
+        self._expansions = {}
 
     def __del__(self):
         self.ftp.close()
 
+    def checksums(self, paths):
+        """Return SHA-256 digests of remote files using as few commands as possible, with None for files that could not be read."""
+        chunks, size = [[]], 0
+        for path in map(shlex.quote, paths):
+            if chunks[-1] and size + len(path) + 1 > COMMAND_SIZE:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(path)
+            size += len(path) + 1
+        digests = []
+        for chunk in chunks:
+            if chunk:
+                stdouts = self.ssh.exec_command(f'for path in {" ".join(chunk)}; do sha256sum < "$path" 2> /dev/null || echo; done', error=False)  # noqa: Q000
+                if len(stdouts) != len(chunk):
+                    raise RuntimeError('Failed to compute checksums:\n' + '\n'.join(stdouts))
+                digests += [x.split()[0] if x.strip() else None for x in stdouts]
+        return digests
+
     def exec_commands(self, commands):
+        self._directories.clear()
+        self.expand(x for command in commands if not command.startswith(LOCAL_FUNCTIONS) for x in shlex.split(command, posix=False)[1:] if _expandable(x))
         pbars = [tqdm(desc=x.split()[0], bar_format=PBAR_FORMAT, position=0) if any(x.split()[0] == y for y in PBAR_FUNCTIONS) else None for x in commands]
         for command, pbar in zip(commands, pbars):
             argv = shlex.split(command, posix=False)
@@ -63,56 +128,65 @@ class SFTP:
                 output = getattr(self.ftp, function)(self.normalize(argv[1]))
 
             elif argv[0] == 'get':
-                recurse = bool([x for x in argv if x.startswith('-') and 'r' in x])
-                resume = bool([x for x in argv if x.startswith('-') and 'a' in x])
-                argv = [x for x in argv if not x.startswith('-')]
+                flags, options, argv = parse_argv(argv, options=('j',))
+                recurse, resume, check, verify = 'r' in flags, 'a' in flags, 'c' in flags, bool(flags & {'v', 'verify'})
+                workers = int(options.get('j', self.workers))
                 if len(argv) == 2:
                     argv.append(argv[-1])
                 elif len(argv) != 3:
-                    raise ValueError('get [-ra] remote_file [local_file]')
+                    raise ValueError('get [-ractvz] [-j workers] remote_file [local_file]')
                 local, remote = self.lnormalize(argv[2]), self.normalize(argv[1])
-                if stat.S_ISDIR(self.ftp.stat(remote).st_mode):
-                    pbar.reset(sum(len(filenames) for i, (_, _, filenames) in enumerate(self.walk(remote)) if recurse or i == 0))
-                    for dirpath, _, filenames in self.walk(remote):
+                stats = self.ftp.stat(remote)
+                if stat.S_ISDIR(stats.st_mode) and recurse and 't' in flags:
+                    if verify:
+                        raise ValueError('get -v is not supported with -t')
+                    pbar_bytes(pbar, None)
+                    self.get_tar(remote, local, compress='z' in flags, callback=pbar.update)
+                elif stat.S_ISDIR(stats.st_mode):
+                    pairs = []
+                    for dirpath, _, fileattrs in self.listdir_tree(remote, recurse, workers=workers):
                         root = local + os.path.sep.join(dirpath.replace(remote, '').split('/'))
                         os.makedirs(root, exist_ok=True)  # noqa: PL103
-                        for filename in filenames:
-                            pbar.set_postfix_str(filename, refresh=False)
-                            self.get(f'{dirpath}/{filename}', os.path.join(root, filename), resume)
-                            pbar.update()
-                        if not recurse:
-                            break
+                        pairs += [(f'{dirpath}/{x.filename}', os.path.join(root, x.filename), x) for x in fileattrs]  # noqa: PL118
+                    pbar.reset(len(pairs))
+                    with self.verify('get', pairs, verify) as digests:
+                        self.transfer(self.get, pairs, resume, workers, pbar, check=check, digests=digests)
                 else:
-                    pbar.reset(1)
-                    self.get(remote, local, resume)
-                    pbar.update()
+                    pbar_bytes(pbar, stats.st_size)
+                    with self.verify('get', [(remote, local)], verify) as digests:
+                        self.get(remote, local, resume, check=check, workers=workers, callback=pbar.update, stats=stats, digests=digests)
                 pbar.set_postfix_str('', refresh=False)
                 pbar.close()
 
             elif argv[0] == 'put':
-                recurse = bool([x for x in argv if x.startswith('-') and 'r' in x])
-                resume = bool([x for x in argv if x.startswith('-') and 'a' in x])
-                argv = [x for x in argv if not x.startswith('-')]
+                flags, options, argv = parse_argv(argv, options=('j',))
+                recurse, resume, check, verify = 'r' in flags, 'a' in flags, 'c' in flags, bool(flags & {'v', 'verify'})
+                workers = int(options.get('j', self.workers))
                 if len(argv) == 2:
                     argv.append(argv[-1])
                 elif len(argv) != 3:
-                    raise ValueError('put [-ra] local_file [remote_file]')
+                    raise ValueError('put [-ractvz] [-j workers] local_file [remote_file]')
                 local, remote = self.lnormalize(argv[1]), self.normalize(argv[2])
-                if os.path.isdir(local):  # noqa: PL112
-                    pbar.reset(sum(len(filenames) for i, (_, _, filenames) in enumerate(os.walk(local)) if recurse or i == 0))
+                if os.path.isdir(local) and recurse and 't' in flags:  # noqa: PL112
+                    if verify:
+                        raise ValueError('put -v is not supported with -t')
+                    pbar_bytes(pbar, None)
+                    self.put_tar(local, remote, compress='z' in flags, callback=pbar.update)
+                elif os.path.isdir(local):  # noqa: PL112
+                    pairs, roots = [], []
                     for dirpath, _, filenames in os.walk(local):
-                        root = remote + '/'.join(dirpath.replace(local, '').split(os.path.sep))
-                        self.mkdirs(root)
-                        for filename in filenames:
-                            pbar.set_postfix_str(filename, refresh=False)
-                            self.put(os.path.join(dirpath, filename), f'{root}/{filename}', resume)
-                            pbar.update()
+                        roots.append(remote + '/'.join(dirpath.replace(local, '').split(os.path.sep)))
+                        pairs += [(os.path.join(dirpath, filename), f'{roots[-1]}/{filename}') for filename in filenames]  # noqa: PL118
                         if not recurse:
                             break
+                    self.mkdirs(*roots)
+                    pbar.reset(len(pairs))
+                    with self.verify('put', pairs, verify) as digests:
+                        self.transfer(self.put, pairs, resume, workers, pbar, check=check, digests=digests)
                 else:
-                    pbar.reset(1)
-                    self.put(local, remote, resume)
-                    pbar.update()
+                    pbar_bytes(pbar, os.path.getsize(local))
+                    with self.verify('put', [(local, remote)], verify) as digests:
+                        self.put(local, remote, resume, check=check, workers=workers, callback=pbar.update, digests=digests)
                 pbar.set_postfix_str('', refresh=False)
                 pbar.close()
 
@@ -155,9 +229,13 @@ class SFTP:
                 output = getattr(self.ftp, function)(self.normalize(argv[1]))
 
             elif argv[0] == 'mkdir':
+                flags, _, argv = parse_argv(argv)
                 if len(argv) != 2:
-                    raise ValueError('mkdir remote_directory')
-                output = getattr(self.ftp, function)(self.normalize(argv[1]))
+                    raise ValueError('mkdir [-p] remote_directory')
+                if 'p' in flags:
+                    self.mkdirs(self.normalize(argv[1]))
+                else:
+                    output = getattr(self.ftp, function)(self.normalize(argv[1]))
 
             elif argv[0] == 'rm':
                 recurse = bool([x for x in argv if x.startswith('-') and 'r' in x])
@@ -166,35 +244,75 @@ class SFTP:
                     raise ValueError('rm [-r] remote_file')
                 remote = self.normalize(argv[1])
                 try:
-                    self.ftp.stat(remote)
-                    exists = True
+                    stats = self.ftp.stat(remote)
                 except FileNotFoundError:
-                    exists = False
-                if not exists:
+                    stats = None
+                if stats is None:
                     pass
-                elif recurse and stat.S_ISDIR(self.ftp.stat(remote).st_mode):
-                    pbar.reset(sum(len(filenames) for i, (_, _, filenames) in enumerate(self.walk(remote, topdown=False))))
-                    for dirpath, dirnames, filenames in self.walk(remote, topdown=False):
-                        for filename in filenames:
-                            pbar.set_postfix_str(filename, refresh=False)
-                            self.ftp.remove(f'{dirpath}/{filename}')
+                elif recurse and stat.S_ISDIR(stats.st_mode) and self._exec_bulk('rm -rf --', [remote]):
+                    pbar.reset(1)
+                    pbar.update()
+                elif recurse and stat.S_ISDIR(stats.st_mode):
+                    listing = self.listdir_tree(remote)
+                    pbar.reset(sum(len(fileattrs) for _, _, fileattrs in listing))
+                    for dirpath, dirattrs, fileattrs in reversed(listing):
+                        for attr in fileattrs:
+                            pbar.set_postfix_str(attr.filename, refresh=False)
+                            self.ftp.remove(f'{dirpath}/{attr.filename}')
                             pbar.update()
-                        for dirname in dirnames:
-                            self.ftp.rmdir(f'{dirpath}/{dirname}')
+                        for attr in dirattrs:
+                            self.ftp.rmdir(f'{dirpath}/{attr.filename}')
                     self.ftp.rmdir(remote)
                 else:
                     pbar.reset(1)
                     self.ftp.remove(remote)
                     pbar.update()
+                self._forget(remote)
                 pbar.set_postfix_str('', refresh=False)
                 pbar.close()
 
+            elif argv[0] == 'rename':
+                output = getattr(self.ftp, function)(*argv[1:])
+                self._forget(self.normalize(argv[1]))  # may have been created by mkdirs
+
             elif argv[0] == 'rmdir':
                 if len(argv) != 2:
                     raise ValueError('rmdir remote_directory')
                 output = getattr(self.ftp, function)(self.normalize(argv[1]))
+                self._forget(self.normalize(argv[1]))
+
+            elif argv[0] == 'sync':
+                flags, options, argv = parse_argv(argv, options=('j',))
+                workers = int(options.get('j', self.workers))
+                if len(argv) == 3:
+                    argv.append(argv[-1])
+                if len(argv) != 4 or argv[1] not in ('get', 'put'):
+                    raise ValueError('sync [-cd] [-j workers] get|put source [destination]')
+                if argv[1] == 'get':
+                    local, remote = self.lnormalize(argv[3]), self.normalize(argv[2])
+                else:
+                    local, remote = self.lnormalize(argv[2]), self.normalize(argv[3])
+                self.sync(argv[1], local, remote, checksum='c' in flags, delete='d' in flags, workers=workers, pbar=pbar)
+                pbar.set_postfix_str('', refresh=False)
+                pbar.close()
+
+            elif argv[0] in ('chmod', 'chown'):
+                flags, _, argv = parse_argv(argv)
+                if len(argv) != 3:
+                    raise ValueError(f'{argv[0]} [-R] {"mode" if argv[0] == "chmod" else "owner[:group]"} remote_path')  # noqa: Q000
+                remote = self.normalize(argv[2])
+                if 'R' not in flags or not self._exec_bulk(f'{argv[0]} -R {shlex.quote(argv[1])} --', [remote]):
+                    remotes = [remote]
+                    if 'R' in flags and stat.S_ISDIR(self.ftp.stat(remote).st_mode):
+                        remotes += [f'{dirpath}/{x.filename}' for dirpath, dirattrs, fileattrs in self.listdir_tree(remote) for x in dirattrs + fileattrs]
+                    for path in remotes:
+                        if argv[0] == 'chmod':
+                            self.ftp.chmod(path, int(argv[1], 8))
+                        else:
+                            uid, _, gid = argv[1].partition(':')
+                            self.ftp.chown(path, int(uid), int(gid) if gid else self.ftp.lstat(path).st_gid)
 
-            else:  # 'chmod', 'chown', 'ln', 'pwd', 'rename', 'symlink'
+            else:  # 'ln', 'pwd', 'symlink'
                 output = getattr(self.ftp, function)(*argv[1:])
 
             if argv[0] in ('pwd', 'lpwd'):
@@ -203,79 +321,697 @@ class SFTP:
             elif argv[0] in ('ls', 'lls'):
                 print('\n'.join(sorted(output, key=sort_key_natural)))
 
-    def get(self, remote, local, resume=False):
-        try:
-            if not resume:
-                raise OSError
-            remote_timestamp = datetime.datetime.fromtimestamp(self.ftp.stat(remote).st_mtime)
-            local_timestamp = datetime.datetime.fromtimestamp(os.stat(local)[stat.ST_MTIME])
-            if remote_timestamp > local_timestamp:
-                raise OSError
-        except OSError:
-            self.ftp.get(remote, local)
-            stats = self.ftp.stat(remote)
+    def expand(self, paths):
+        """Expand environment variables and ~user in remote paths using a single command, caching the results for the session."""
+        paths = [x for x in dict.fromkeys(_unquote(x) for x in paths) if x not in self._expansions]
+        if paths:
+            stdouts = self.ssh.exec_command("printf '%s\\n' " + ' '.join(_quote_expandable(x) for x in paths))
+            if len(stdouts) != len(paths):
+                raise FileNotFoundError(f'Failed to expand {", ".join(paths)}')
+            self._expansions.update(zip(paths, stdouts))
+
+    @metrics.timed('transfer')
+    def get(self, remote, local, resume=False, ftp=None, check=False, workers=1, callback=None, stats=None, digests=None):
+        """Download a file, continuing a partial download from the size of the local file when resuming.
+
+        Files larger than RANGE_SIZE are split into byte ranges that are downloaded concurrently over workers sessions.
+        Attributes of the remote file are requested unless already known from a listing.
+        If digests is a dictionary, the SHA-256 digest of the local file is stored in it, computed from the data as it is written where possible.
+        """
+        if ftp is None:
+            remote = posixpath.join(self.ftp.getcwd() or self.home, remote)
+        with self._borrow(ftp) as ftp:
+            stats = ftp.stat(remote) if stats is None else stats
+            offset = self._offset(stats, os.stat(local) if resume and os.path.isfile(local) else None, remote, local, check)  # noqa: PL113, PL116
+            if offset is None:
+                if callback is not None:
+                    callback(stats.st_size)
+                if digests is not None:
+                    digests[local] = _sha256(local).hexdigest()
+                return
+            if offset == 0:
+                open(local, 'wb').close()  # noqa: PL123
+            elif callback is not None:
+                callback(offset)
+            digest = _sha256(local, offset) if digests is not None and (workers <= 1 or stats.st_size - offset <= RANGE_SIZE) else None
+            self._copy(functools.partial(self._read, remote, local, digest=digest), offset, stats.st_size, ftp, workers, callback, functools.partial(os.truncate, local))
             os.utime(local, (stats.st_atime, stats.st_mtime))
+            if digests is not None:
+                digests[local] = (digest or _sha256(local)).hexdigest()
+
+    def get_tar(self, remote, local, compress=False, callback=None):
+        """Stream a remote directory as a tar archive over a single channel and extract it locally, preserving mtimes and permissions."""
+        channel = self.ssh.get_transport().open_session()
+        command = f'tar -C {shlex.quote(remote)} -c{"z" if compress else ""}f - .'
+        logging.getLogger('ipyslurm.sftp').debug(f'Streaming "{command}"')
+        channel.exec_command(command)
+        metrics.count('exec_channels')
+        os.makedirs(local, exist_ok=True)  # noqa: PL103
+        kwargs = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}  # the archive is of the user's own tree, so keep modes like the default before filters
+        with tarfile.open(fileobj=_Stream(channel, callback, self.tuning.throttle), mode='r|gz' if compress else 'r|') as tar:
+            tar.extractall(local, **kwargs)
+        _verify_exit_status(channel, command)
+
+    def listdir_tree(self, top, recurse=True, followlinks=False, workers=None):
+        """List a remote tree in a single pass, returning [(dirpath, dirattrs, fileattrs)] in top-down order.
+
+        Directories are listed concurrently over a pool of SFTP sessions, and the attributes are kept to avoid further stat requests.
+        """
+        workers = self.workers if workers is None else workers
+
+        def listdir(dirpath):
+            try:
+                if workers > 1:
+                    with self.session() as ftp:
+                        return ftp.listdir_attr(dirpath)
+                return self.ftp.listdir_attr(dirpath)
+            except FileNotFoundError:
+                raise FileNotFoundError(f'Failed to list contents of "{dirpath}"')
+
+        listing = {}
+        with futures.ThreadPoolExecutor(max(workers, 1)) as executor:
+            tasks = {executor.submit(listdir, top): top}
+            while tasks:
+                done, _ = futures.wait(tasks, return_when=futures.FIRST_COMPLETED)
+                for task in done:
+                    dirpath = tasks.pop(task)
+                    attrs = task.result()
+                    listing[dirpath] = [x for x in attrs if stat.S_ISDIR(x.st_mode)], [x for x in attrs if not stat.S_ISDIR(x.st_mode)]
+                    if recurse:
+                        for attr in listing[dirpath][0]:
+                            if followlinks or not stat.S_ISLNK(attr.st_mode):
+                                tasks[executor.submit(listdir, f'{dirpath}/{attr.filename}')] = f'{dirpath}/{attr.filename}'
+        tree, dirpaths = [], [top]
+        while dirpaths:
+            dirpath = dirpaths.pop()
+            dirattrs, fileattrs = listing[dirpath]
+            tree.append((dirpath, dirattrs, fileattrs))
+            dirpaths += reversed([f'{dirpath}/{x.filename}' for x in dirattrs if f'{dirpath}/{x.filename}' in listing])
+        return tree
+
+    def lmanifest(self, top, checksum=False):
+        """Return {relative path: (size, mtime, sha256)} of files under a local directory."""
+        manifest = {}
+        for dirpath, _, filenames in os.walk(top):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)  # noqa: PL118
+                stats = os.stat(filepath)  # noqa: PL116
+                digest = None
+                if checksum:
+                    with open(filepath, 'rb') as f:  # noqa: PL123
+                        digest = hashlib.sha256()
+                        for data in iter(functools.partial(f.read, 2 ** 20), b''):
+                            digest.update(data)
+                        digest = digest.hexdigest()
+                manifest[os.path.relpath(filepath, top).replace(os.path.sep, '/')] = (stats.st_size, stats.st_mtime, digest)
+        return manifest
 
     def lnormalize(self, path):
-        if path.startswith('"'):
-            path = path.replace('"', '')
-        elif path.startswith("'"):
-            path = path.replace("'", '')
+        path = _unquote(path)
         return os.path.abspath(os.path.expandvars(os.path.expanduser(path)))  # noqa: PL100
 
-    def mkdirs(self, path):
-        path = pathlib.PurePosixPath(path)
-        dirpath = pathlib.PurePosixPath(path.parts[0])
-        for part in path.parts:
-            dirpath = dirpath / part
+    def manifest(self, top, checksum=False):
+        """Return {relative path: (size, mtime, sha256)} of files under a remote directory using a single command."""
+        separator = '<<< ipyslurm manifest separator >>>'
+        top = shlex.quote(top)
+        command = f"if [ -d {top} ]; then cd {top} && find . -type f -printf '%s %T@ %P\\n'"
+        if checksum:
+            command += f" && echo '{separator}' && find . -type f -print0 | xargs -0 -r sha256sum"
+        stdouts = self.ssh.exec_command(command + '; fi')
+        stats, digests = (split_list(stdouts, separator) + [[]])[:2]
+        digests = dict(reversed(x.split(maxsplit=1)) for x in digests if x)
+        manifest = {}
+        for line in stats:
+            if line:
+                size, mtime, filepath = line.split(' ', 2)
+                manifest[filepath] = (int(size), float(mtime), digests.get(f'./{filepath}'))
+        return manifest
+
+    def mkdirs(self, *paths):
+        """Create remote directories and their parents, skipping those already known to exist.
+
+        Directories are created with a single mkdir -p command where possible, falling back to an SFTP request for each missing parent.
+        """
+        paths = [x for x in dict.fromkeys(posixpath.normpath(x) for x in paths) if x not in self._directories]
+        if paths and not self._exec_bulk('mkdir -p --', paths):
+            for path in paths:
+                for dirpath in reversed((pathlib.PurePosixPath(path), *pathlib.PurePosixPath(path).parents)):
+                    if str(dirpath) not in self._directories:
+                        try:
+                            self.ftp.mkdir(str(dirpath))
+                        except OSError:
+                            pass
+                        self._directories.add(str(dirpath))
+        for path in paths:
+            self._directories.update(str(x) for x in (pathlib.PurePosixPath(path), *pathlib.PurePosixPath(path).parents))
+
+    @metrics.timed('normalize')
+    def normalize(self, path, cwd=None):
+        """Return the absolute form of a remote path, resolved against cwd or the current remote directory without a round trip.
+
+        Environment variables and ~user are expanded remotely, see expand.
+        """
+        path = _unquote(path)
+        if _expandable(path):
+            self.expand([path])
+            path = self._expansions[path]
+        elif path == '~' or path.startswith('~/'):
+            path = self.home + path[1:]
+        return posixpath.normpath(posixpath.join(cwd or self.ftp.getcwd() or self.home, path))
+
+    def open(self, path, block_size=BLOCK_SIZE, cache_size=64, readahead=8, workers=4):  # noqa: A003
+        """Open a remote file for random access without downloading it, see RemoteFile."""
+        return RemoteFile(self, self.normalize(path), block_size, cache_size, readahead, workers)
+
+    def prune_uploads(self, days=30):
+        """Remove files from CACHE_DIRECTORY that were uploaded more than days ago, including interrupted uploads, and return how many were removed.
+
+        Pruned contents are uploaded again when next needed, see upload.
+        """
+        directory = posixpath.join(self.home, CACHE_DIRECTORY)
+        try:
+            attrs = self.ftp.listdir_attr(directory)
+        except FileNotFoundError:
+            return 0
+        expired = [posixpath.join(directory, x.filename) for x in attrs if stat.S_ISREG(x.st_mode) and x.st_mtime < time.time() - days * 86400]
+        for path in expired:
+            self.ftp.remove(path)
+        logging.getLogger('ipyslurm.sftp').debug(f'Removed {len(expired)} file(s) from "{directory}"')
+        return len(expired)
+
+    @metrics.timed('transfer')
+    def put(self, local, remote, resume=False, ftp=None, check=False, workers=1, callback=None, stats=None, digests=None):
+        """Upload a file, continuing a partial upload from the size of the remote file when resuming.
+
+        Files larger than RANGE_SIZE are split into byte ranges that are uploaded concurrently over workers sessions.
+        If digests is a dictionary, the SHA-256 digest of the local file is stored in it, computed from the data as it is read where possible.
+        """
+        if ftp is None:
+            remote = posixpath.join(self.ftp.getcwd() or self.home, remote)
+        with self._borrow(ftp) as ftp:
+            stats = os.stat(local) if stats is None else stats  # noqa: PL116
             try:
-                self.ftp.mkdir(str(dirpath))
-            except OSError:
-                pass
-
-    def normalize(self, path):
-        if path.startswith('"'):
-            path = path.replace('"', '')
-        elif path.startswith("'"):
-            path = path.replace("'", '')
-        cwd = self.ftp.getcwd()
-        if cwd is not None:
-            path = f'{cwd}/{path}'
-        stdouts = self.ssh.exec_command(f'readlink -m "{path}"')
-        if len(stdouts) != 1:
-            raise FileNotFoundError(f'Failed to find {path}')
-        return stdouts[0]
-
-    def put(self, local, remote, resume=False):
+                offset = self._offset(stats, ftp.stat(remote) if resume else None, remote, local, check)
+            except FileNotFoundError:
+                offset = 0
+            if offset is None:
+                if callback is not None:
+                    callback(stats.st_size)
+                if digests is not None:
+                    digests[local] = _sha256(local).hexdigest()
+                return
+            if offset == 0:
+                ftp.open(remote, 'wb').close()
+            elif callback is not None:
+                callback(offset)
+            digest = _sha256(local, offset) if digests is not None and (workers <= 1 or stats.st_size - offset <= RANGE_SIZE) else None
+            self._copy(functools.partial(self._write, local, remote, digest=digest), offset, stats.st_size, ftp, workers, callback, functools.partial(ftp.truncate, remote))
+            ftp.utime(remote, (stats.st_atime, stats.st_mtime))
+            if digests is not None:
+                digests[local] = (digest or _sha256(local)).hexdigest()
+
+    def put_tar(self, local, remote, compress=False, callback=None):
+        """Stream a local directory as a tar archive over a single channel and extract it remotely, preserving mtimes and permissions."""
+        channel = self.ssh.get_transport().open_session()
+        command = f'mkdir -p {shlex.quote(remote)} && tar -C {shlex.quote(remote)} -x{"z" if compress else ""}pf -'
+        logging.getLogger('ipyslurm.sftp').debug(f'Streaming "{command}"')
+        channel.exec_command(command)
+        metrics.count('exec_channels')
         try:
-            if not resume:
-                raise OSError
-            local_timestamp = datetime.datetime.fromtimestamp(os.stat(local)[stat.ST_MTIME])
-            remote_timestamp = datetime.datetime.fromtimestamp(self.ftp.stat(remote).st_mtime)
-            if local_timestamp > remote_timestamp:
-                raise OSError
+            with tarfile.open(fileobj=_Stream(channel, callback, self.tuning.throttle), mode='w|gz' if compress else 'w|') as tar:
+                tar.add(local, arcname='.')
         except OSError:
-            self.ftp.put(local, remote)
-            stats = os.stat(local)  # noqa: PL116
-            self.ftp.utime(remote, (stats.st_atime, stats.st_mtime))
+            _verify_exit_status(channel, command)
+            raise
+        channel.shutdown_write()
+        _verify_exit_status(channel, command)
+
+    def session(self):
+        """Borrow an idle SFTP session on the same transport with the current window and packet sizes, see SSH.session."""
+        return self.ssh.session(self.tuning.window_size, self.tuning.max_packet_size)
+
+    def sync(self, direction, local, remote, checksum=False, delete=False, workers=None, pbar=None):
+        """Transfer only new or changed files between local and remote directories, optionally deleting extraneous ones.
+
+        Files are compared by size and mtime, or by content hash if checksum is set.
+        The source directory must exist, so that a mistyped path cannot delete the destination.
+        """
+        if direction == 'get':
+            try:
+                exists = stat.S_ISDIR(self.ftp.stat(remote).st_mode)
+            except FileNotFoundError:
+                exists = False
+        else:
+            exists = os.path.isdir(local)  # noqa: PL112
+        if not exists:
+            raise FileNotFoundError(f'No such directory: "{remote if direction == "get" else local}"')
+        lmanifest, rmanifest = self.lmanifest(local, checksum), self.manifest(remote, checksum)
+        if direction == 'get':
+            source, destination = rmanifest, lmanifest
+        else:
+            source, destination = lmanifest, rmanifest
+        changed = []
+        for filepath, (size, mtime, digest) in sorted(source.items()):
+            if filepath in destination:
+                size_, mtime_, digest_ = destination[filepath]
+                if size == size_ and (digest == digest_ if checksum else int(mtime) == int(mtime_)):
+                    continue
+            changed.append(filepath)
+        extraneous = sorted(set(destination) - set(source)) if delete else []
+        logging.getLogger('ipyslurm.sftp').debug(f'Synchronizing {len(changed)} changed and {len(extraneous)} extraneous files')
+        if direction == 'get':
+            for dirpath in sorted({posixpath.dirname(x) for x in changed}):
+                os.makedirs(os.path.join(local, *dirpath.split('/')), exist_ok=True)  # noqa: PL103, PL118
+            pairs = [(f'{remote}/{x}', os.path.join(local, *x.split('/'))) for x in changed]  # noqa: PL118
+        else:
+            for dirpath in sorted({posixpath.dirname(x) for x in changed}):
+                self.mkdirs(f'{remote}/{dirpath}'.rstrip('/'))
+            pairs = [(os.path.join(local, *x.split('/')), f'{remote}/{x}') for x in changed]  # noqa: PL118
+        if pbar is not None:
+            pbar.reset(len(pairs) + len(extraneous))
+        self.transfer(getattr(self, direction), pairs, workers=workers, pbar=pbar)
+        if direction == 'put' and extraneous and self._exec_bulk('rm -f --', [f'{remote}/{x}' for x in extraneous]):
+            if pbar is not None:
+                pbar.update(len(extraneous))
+            extraneous = []
+        for filepath in extraneous:
+            if direction == 'get':
+                os.remove(os.path.join(local, *filepath.split('/')))  # noqa: PL107, PL118
+            else:
+                self.ftp.remove(f'{remote}/{filepath}')
+            if pbar is not None:
+                pbar.set_postfix_str(posixpath.basename(filepath), refresh=False)
+                pbar.update()
+
+    def transfer(self, function, pairs, resume=False, workers=None, pbar=None, **kwargs):
+        """Apply get or put to (source, destination[, stats]) pairs, fanning out over a pool of SFTP sessions.
+
+        Failures do not interrupt the remaining transfers and are reported per file once all transfers are complete.
+        """
+        workers = self.workers if workers is None else workers
+        pairs = [(source, destination, dict(kwargs, stats=stats[0] if stats else None)) for source, destination, *stats in pairs]
+        errors = []
+
+        def done(source, error):
+            if error is not None:
+                logging.getLogger('ipyslurm.sftp').debug(f'Failed to transfer "{source}": {error}')
+                errors.append(f'"{source}": {error}')
+            if pbar is not None:
+                pbar.set_postfix_str(pathlib.PurePath(source).name, refresh=False)
+                pbar.update()
+
+        if workers > 1:
+            with futures.ThreadPoolExecutor(workers) as executor:
+                tasks = {executor.submit(self._transfer, function, source, destination, resume, **kwargs_): source for source, destination, kwargs_ in pairs}
+                for task in futures.as_completed(tasks):
+                    done(tasks[task], task.exception())
+        else:
+            for source, destination, kwargs_ in pairs:
+                try:
+                    function(source, destination, resume, **kwargs_)
+                except Exception as e:
+                    done(source, e)
+                else:
+                    done(source, None)
+        if errors:
+            raise RuntimeError(f'Failed to transfer {len(errors)} file(s):\n' + '\n'.join(errors))
+
+    @contextlib.contextmanager
+    def tuned(self, profile=None, limit=None):
+        """Temporarily apply a tuning profile and bandwidth limit to transfers of this client, see Tuning."""
+        tuning = self.tuning
+        if profile is not None or limit is not None:
+            self.tuning = Tuning(tuning.profile if profile is None else profile, tuning.limit if limit is None else limit, tuning.rtt).measure(self.ssh)
+        try:
+            yield self
+        finally:
+            self.tuning = tuning
+
+    def upload(self, contents, mode=0o700):
+        """Store contents remotely under their SHA-256 digest in CACHE_DIRECTORY and return their paths.
+
+        Contents already stored are not sent again, and new files are written under a temporary name and renamed once complete.
+        Only the needed digests are checked, with pipelined stat requests, since the cache may be cleaned up remotely at any time, see prune_uploads.
+        """
+        directory = posixpath.join(self.home, CACHE_DIRECTORY)
+        paths, uploads = [], {}
+        for content in contents:
+            data = content.encode() if isinstance(content, str) else content
+            paths.append(posixpath.join(directory, hashlib.sha256(data).hexdigest()))
+            uploads[paths[-1]] = data
+        exists, *stats = self.ftp.stat_many([directory, *uploads])
+        if exists is None:
+            self._forget(directory)
+            self.mkdirs(directory)
+        pending = {x: y for (x, y), z in zip(uploads.items(), stats) if z is None}
+
+        def write(path, data):
+            with self.session() if len(pending) > 1 else contextlib.nullcontext(self.ftp) as ftp:
+                temporary = f'{path}.{uuid.uuid4().hex}'
+                with ftp.open(temporary, 'wb') as f:
+                    f.write(data)
+                    f.chmod(mode)
+                ftp.posix_rename(temporary, path)
+
+        with futures.ThreadPoolExecutor(max(min(len(pending), UPLOAD_WORKERS), 1)) as executor:
+            for task in [executor.submit(write, *x) for x in pending.items()]:
+                task.result()
+        return paths
+
+    @contextlib.contextmanager
+    def verify(self, direction, pairs, enabled=True):
+        """Compare digests of transferred files collected within the context against digests of the remote files.
+
+        Remote files are hashed with a single command that runs alongside downloads, or once uploads are complete.
+        """
+        if not enabled:
+            yield None
+            return
+        remotes, locals_ = zip(*((x[0], x[1]) if direction == 'get' else (x[1], x[0]) for x in pairs)) if pairs else ((), ())
+        digests = {}
+        executor = futures.ThreadPoolExecutor(1)
+        try:
+            checksums = executor.submit(self.checksums, remotes) if direction == 'get' else None
+            yield digests
+            checksums = checksums.result() if checksums is not None else self.checksums(remotes)
+        finally:
+            executor.shutdown(wait=False)
+        failed = [f'"{x}"' for x, y, z in zip(remotes, locals_, checksums) if z is None or digests.get(y) != z]
+        if failed:
+            raise RuntimeError(f'Failed to verify {len(failed)} file(s):\n' + '\n'.join(failed))
+        logging.getLogger('ipyslurm.sftp').debug(f'Verified {len(remotes)} file(s)')
 
     def walk(self, top, topdown=True, followlinks=False):
-        dirnames, filenames = [], []
+        listing = self.listdir_tree(top, followlinks=followlinks)
+        for dirpath, dirattrs, fileattrs in listing if topdown else reversed(listing):
+            yield dirpath, [x.filename for x in dirattrs], [x.filename for x in fileattrs]
+
+    def _borrow(self, ftp=None):
+        """Return a context of the given session, else of the main session unless it was opened with other window or packet sizes than the current tuning, e.g., within tuned or after autotuning, in which case a matching session is borrowed."""
+        if ftp is None:
+            channel = self.ftp.get_channel()
+            if (channel.in_window_size, channel.in_max_packet_size) != (self.tuning.window_size, self.tuning.max_packet_size):
+                return self.session()
+            ftp = self.ftp
+        return contextlib.nullcontext(ftp)
+
+    def _copy(self, function, start, stop, ftp, workers=1, callback=None, truncate=None):
+        if workers <= 1 or stop - start <= RANGE_SIZE:
+            function(ftp, start, stop, callback)
+            return
+        ranges = [(x, min(x + RANGE_SIZE, stop)) for x in range(start, stop, RANGE_SIZE)]
+        with futures.ThreadPoolExecutor(workers) as executor:
+            tasks = {executor.submit(self._range, function, x, y, callback): x for x, y in ranges}
+            try:
+                for task in futures.as_completed(tasks):
+                    task.result()
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                executor.shutdown(wait=True)  # ranges in flight must finish writing before truncating
+                if truncate is not None:
+                    # keep only the contiguous prefix so that the transfer can be resumed
+                    done = {x for task, x in tasks.items() if not task.cancelled() and task.exception() is None}
+                    offset = start
+                    for x, y in ranges:
+                        if x not in done:
+                            break
+                        offset = y
+                    truncate(offset)
+                raise
+
+    def _exec_bulk(self, command, paths):
+        """Apply a command to paths on the server in as few executions as possible, returning False if SFTP should be used instead."""
+        if not self._exec:
+            return False
+        chunks, size = [[]], len(command)
+        for path in map(shlex.quote, paths):
+            if chunks[-1] and size + len(path) + 1 > COMMAND_SIZE:
+                chunks.append([])
+                size = len(command)
+            chunks[-1].append(path)
+            size += len(path) + 1
         try:
-            attrs = self.ftp.listdir_attr(top)
-        except FileNotFoundError:
-            raise FileNotFoundError(f'Failed to list contents of "{top}"')
-        for attr in attrs:
-            if stat.S_ISDIR(attr.st_mode):
-                dirnames.append(attr)
-            else:
-                filenames.append(attr)
-        if topdown:
-            yield top, [x.filename for x in dirnames], [x.filename for x in filenames]
-        for attr in dirnames:
-            dirpath = f'{top}/{attr.filename}'
-            if followlinks or not stat.S_ISLNK(attr.st_mode):
-                for x in self.walk(dirpath, topdown, followlinks):
-                    yield x
-        if not topdown:
-            yield top, [x.filename for x in dirnames], [x.filename for x in filenames]
+            for chunk in chunks:
+                self.ssh.exec_command(' '.join([command] + chunk))
+        except paramiko.SSHException as e:
+            logging.getLogger('ipyslurm.sftp').debug(f'Falling back to SFTP after failure to execute commands: {e}')
+            self._exec = False
+            return False
+        except RuntimeError as e:
+            logging.getLogger('ipyslurm.sftp').debug(f'Falling back to SFTP after failure of "{command}": {e}')
+            return False
+        return True
+
+    def _forget(self, path):
+        self._directories = {x for x in self._directories if x != path and not x.startswith(f'{path}/')}
+
+    def _offset(self, source, destination, remote, local, check=False):
+        """Return the offset to resume a transfer from, or None if the destination is up to date."""
+        if destination is None:
+            return 0
+        if destination.st_size == source.st_size and int(destination.st_mtime) >= int(source.st_mtime):
+            return None
+        if 0 < destination.st_size < source.st_size and (not check or self._tail_matches(remote, local, destination.st_size)):
+            return destination.st_size
+        return 0
+
+    def _range(self, function, start, stop, callback):
+        with self.session() as ftp:
+            function(ftp, start, stop, callback)
+
+    def _read(self, remote, local, ftp, start, stop, callback=None, digest=None):
+        with ftp.open(remote, 'rb') as fr, open(local, 'r+b') as fl:  # noqa: PL123
+            fl.seek(start)
+            for offset in range(start, stop, READAHEAD_SIZE):
+                chunks = [(x, min(CHUNK_SIZE, stop - x)) for x in range(offset, min(offset + READAHEAD_SIZE, stop), CHUNK_SIZE)]
+                for data in fr.readv(chunks):
+                    self.tuning.throttle(len(data))
+                    metrics.count('bytes_received', len(data))
+                    fl.write(data)
+                    if digest is not None:
+                        digest.update(data)
+                    if callback is not None:
+                        callback(len(data))
+
+    def _tail_matches(self, remote, local, size):
+        start = max(size - TAIL_SIZE, 0)
+        with open(local, 'rb') as f:  # noqa: PL123
+            f.seek(start)
+            digest = hashlib.sha256(f.read(size - start)).hexdigest()
+        stdouts = self.ssh.exec_command(f'tail -c +{start + 1} {shlex.quote(remote)} | head -c {size - start} | sha256sum', error=False)
+        return bool(stdouts) and stdouts[0].split()[0] == digest
+
+    def _transfer(self, function, source, destination, resume, **kwargs):
+        with self.session() as ftp:
+            function(source, destination, resume, ftp=ftp, **kwargs)
+
+    def _write(self, local, remote, ftp, start, stop, callback=None, digest=None):
+        with open(local, 'rb') as fl, ftp.open(remote, 'r+b') as fr:  # noqa: PL123
+            fl.seek(start)
+            fr.seek(start)
+            fr.set_pipelined(True)
+            while start < stop:
+                data = fl.read(min(CHUNK_SIZE, stop - start))
+                if not data:
+                    break
+                self.tuning.throttle(len(data))
+                metrics.count('bytes_sent', len(data))
+                fr.write(data)
+                if digest is not None:
+                    digest.update(data)
+                start += len(data)
+                if callback is not None:
+                    callback(len(data))
+
+
+class RemoteFile(io.RawIOBase):
+    """Seekable read-only file object backed by SFTP sessions.
+
+    Data is fetched in blocks of block_size bytes that are kept in a least recently used cache of cache_size blocks.
+    Sequential reads prefetch up to readahead blocks, which are requested concurrently over workers sessions.
+    """
+
+    def __init__(self, sftp, path, block_size=BLOCK_SIZE, cache_size=64, readahead=8, workers=4):
+        super().__init__()
+        self.block_size = block_size
+        self.cache_size = max(cache_size, readahead + 1)
+        self.name = path
+        self.readahead = readahead
+        self.sftp = sftp
+        self.size = sftp.ftp.stat(path).st_size
+        self._blocks = collections.OrderedDict()
+        self._executor = futures.ThreadPoolExecutor(workers)
+        self._handles = []
+        self._last = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._position = 0
+        self._stack = contextlib.ExitStack()
+        self._window = 0
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(wait=True)
+            self._stack.close()
+        super().close()
+
+    def prefetch(self, offset, size):
+        """Request blocks that cover a byte range in the background."""
+        with self._lock:
+            for index in range(offset // self.block_size, min(offset + size, self.size) // self.block_size + 1):
+                self._request(index)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        size = max(min(len(view), self.size - self._position), 0)
+        done = 0
+        while done < size:
+            index, start = divmod(self._position + done, self.block_size)
+            data = self._block(index)
+            count = min(len(data) - start, size - done)
+            if count <= 0:
+                break
+            view[done:done + count] = data[start:start + count]
+            done += count
+        self._position += done
+        return done
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+        if self._position < 0:
+            raise ValueError(f'Negative seek position {self._position}')
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def _block(self, index):
+        with self._lock:
+            data = self._blocks.get(index)
+            if data is not None:
+                self._blocks.move_to_end(index)
+            if index != self._last:
+                # grow read-ahead while access is sequential, and stop it on random access
+                self._window = min(max(2 * self._window, 1), self.readahead) if self._last is not None and index == self._last + 1 else 0
+                self._last = index
+                for index_ in range(index + 1, index + 1 + self._window):
+                    self._request(index_)
+            task = self._request(index) if data is None else None
+        return task.result() if task is not None else data
+
+    def _fetch(self, index):
+        start = index * self.block_size
+        stop = min(start + self.block_size, self.size)
+        try:
+            with self._lock:
+                f = self._handles.pop() if self._handles else None
+            if f is None:
+                session = self.sftp.session()
+                f = session.__enter__().open(self.name, 'rb')
+                with self._lock:
+                    self._stack.push(session)
+                    self._stack.callback(f.close)
+            try:
+                data = b''.join(f.readv([(x, min(CHUNK_SIZE, stop - x)) for x in range(start, stop, CHUNK_SIZE)]))
+                self.sftp.tuning.throttle(len(data))
+                metrics.count('bytes_received', len(data))
+            finally:
+                with self._lock:
+                    self._handles.append(f)
+            with self._lock:
+                self._blocks[index] = data
+                while len(self._blocks) > self.cache_size:
+                    self._blocks.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._pending[index]
+        return data
+
+    def _request(self, index):
+        if index * self.block_size >= self.size and index > 0:
+            return None
+        task = self._pending.get(index)
+        if task is None and index not in self._blocks:
+            task = self._pending[index] = self._executor.submit(self._fetch, index)
+        return task
+
+
+class _Stream:
+    """File-like view of a channel for streaming tar archives, reporting transferred bytes."""
+
+    def __init__(self, channel, callback=None, throttle=None):
+        self.channel = channel
+        self.callback = callback
+        self.stdout = channel.makefile('rb')
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.stdout.read(size)
+        if self.throttle is not None:
+            self.throttle(len(data))
+        metrics.count('bytes_received', len(data))
+        if self.callback is not None:
+            self.callback(len(data))
+        return data
+
+    def write(self, data):
+        if self.throttle is not None:
+            self.throttle(len(data))
+        metrics.count('bytes_sent', len(data))
+        self.channel.sendall(data)
+        if self.callback is not None:
+            self.callback(len(data))
+        return len(data)
+
+
+def _sha256(path, size=None):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:  # noqa: PL123
+        while size is None or f.tell() < size:
+            data = f.read(READAHEAD_SIZE if size is None else min(READAHEAD_SIZE, size - f.tell()))
+            if not data:
+                break
+            digest.update(data)
+    return digest
+
+
+def _verify_exit_status(channel, command):
+    status = channel.recv_exit_status()
+    if status > 0:
+        stderr = channel.makefile_stderr('rb').read().decode(errors='replace').strip()
+        raise RuntimeError(f'Command returned with exit code {status}:\nstdin: "{command}"\nstderr: "{stderr}"')
+
+
+def _expandable(path):
+    path = _unquote(path)
+    return '$' in path or (path.startswith('~') and not (path == '~' or path.startswith('~/')))
+
+
+def _quote_expandable(path):
+    """Quote a path for the shell, leaving environment variables and a leading ~user to be expanded."""
+    match = re.match(r'~[\w.-]*/?', path)
+    prefix = match.group() if match else ''
+    path = path[len(prefix):]
+    return prefix + ('"' + re.sub(r'(["\\`])', r'\\\1', path) + '"' if path else '')
+
+
+def _unquote(path):
+    if path.startswith('"'):
+        path = path.replace('"', '')
+    elif path.startswith("'"):
+        path = path.replace("'", '')
+    return path
@@ -1,125 +1,344 @@
+import base64
 import logging
+import os
+import posixpath
 import re
 import shlex
+import time
 
 from IPython.display import clear_output
 from paramiko import AuthenticationException
+from tqdm import tqdm
 
-from . import sftp, ssh, util
+from . import history, sftp, ssh, tracker, util
+from . import stats as metrics
+
+COMMAND_SIZE = 2**16
 
 
 class Slurm:
 
     def __init__(self, *args, **kwargs):
         self.ssh = None
+        self.tracker = tracker.JobTracker(self)
+        self.tuning = None
+        self._details = {}
+        self._history = None
+        self._sftp = None
         if len(args) or len(kwargs):
             self.login(*args, **kwargs)
 
     def __del__(self):
         self.logout()
 
-    def command(self, lines):
+    def collect(self, job, destination='.', workers=8, wait=True, interval=10):
+        """Download StdOut and StdErr of the tasks of a job as they complete, skipping files that are up to date, and return their local paths.
+
+        Task states and output paths are taken from a single scheduler query per poll, see JobTracker.
+        Output directories are listed once per poll and files are downloaded concurrently over workers sessions.
+        Local paths keep the remote path relative to the working directory of the job, or the absolute remote path otherwise, so that outputs with the same name do not collide.
+        """
         self._verify_login()
-        if isinstance(lines, str):
-            lines = lines.splitlines()
-        shebangs = [i for i, x in enumerate(lines) if x.startswith('#!')]
-        command = lines[:shebangs[0]] if shebangs else lines
-        command_init = []
-        for i, j in zip(shebangs, shebangs[1:] + [None]):
-            script = '\n'.join(x.replace("'", "'\"'\"'") for x in lines[slice(i, j)])
-            command_init += [
-                'SCRIPT=$(mktemp)',
-                f"echo '{script}' > $SCRIPT",
-                'chmod +x $SCRIPT']
-            command += ['$SCRIPT']
-        return '\n'.join(self.ssh.exec_command(command_init + command))
+        client = self._sftp_client()
+        os.makedirs(destination, exist_ok=True)  # noqa: PL103
+        collected, errors, filepaths = set(), [], []
+        pbar = tqdm(desc='collect', bar_format=sftp.PBAR_FORMAT, position=0)
+        while True:
+            details = self._job_details(job)
+            tasks = [x for x in details if x['JobState'] not in tracker.ACTIVE_STATES and x['JobId'] not in collected]
+            remotes = {x[y]: x.get('WorkDir') for x in tasks for y in ('StdOut', 'StdErr') if x.get(y) and not x[y].startswith('/dev/')}
+            attrs = {}
+            for dirpath in dict.fromkeys(posixpath.dirname(x) for x in remotes):
+                try:
+                    attrs.update((f'{dirpath}/{x.filename}', x) for _, _, fileattrs in client.listdir_tree(dirpath, recurse=False) for x in fileattrs)
+                except FileNotFoundError as e:
+                    logging.getLogger('ipyslurm.slurm').debug(e)
+            errors += [f'"{x}": not found' for x in remotes if x not in attrs]
+            pairs = [(x, os.path.join(destination, *_relative(x, y).split('/')), attrs[x]) for x, y in remotes.items() if x in attrs]  # noqa: PL118
+            for dirpath in dict.fromkeys(os.path.dirname(x[1]) for x in pairs):
+                os.makedirs(dirpath, exist_ok=True)  # noqa: PL103
+            pbar.total = (pbar.total or 0) + len(pairs)
+            pbar.set_postfix_str(f'{len(collected) + len(tasks)} of {len(details)} tasks', refresh=True)
+            try:
+                client.transfer(client.get, pairs, resume=True, workers=workers, pbar=pbar)
+            except RuntimeError as e:
+                errors += str(e).splitlines()[1:]
+            collected.update(x['JobId'] for x in tasks)
+            filepaths += [x[1] for x in pairs]
+            if not wait or all(x['JobState'] not in tracker.ACTIVE_STATES for x in details):
+                break
+            time.sleep(interval)
+        pbar.set_postfix_str(f'{len(collected)} of {len(details)} tasks', refresh=False)
+        pbar.close()
+        if errors:
+            raise RuntimeError(f'Failed to collect {len(errors)} file(s):\n' + '\n'.join(errors))
+        return filepaths
+
+    def command(self, lines, stream=False):
+        start = time.perf_counter()
+        self._verify_login()
+        command = self._command(lines)
+        if stream:
+            return self._stream(self.ssh.exec_command(command, stream=True), start)
+        try:
+            return '\n'.join(self.ssh.exec_command(command))
+        finally:
+            metrics.observe('command', time.perf_counter() - start)
 
     def disk_usage(self, directory='~', depth=0):
         print(self.command(f'df --human-readable {directory}'))
         print('Size Directory')
         print(self.command(f'du --human-readable --one-file-system --max-depth {depth} {directory} | sort -k2,2 -k1,1hr'))
 
+    def history(self, sync=True, **kwargs):
+        """Return finished jobs from a local store that is synchronized incrementally from sacct, see JobHistory.query for filters."""
+        self._verify_login()
+        if self._history is None:
+            self._history = history.JobHistory(self)
+        if sync:
+            self._history.sync()
+        return self._history.query(**kwargs)
+
     def interact(self):
         self._verify_login()
         self.ssh.invoke_shell()
 
-    def login(self, server, username, password=None, **kwargs):
+    def jobs(self, job=None, refresh=False):
+        """Return state records of a job and its array tasks, or of all watched jobs, from the shared tracker."""
+        self._verify_login()
+        return self.tracker.records(job, refresh=refresh)
+
+    def login(self, server, username, password=None, profile='auto', limit=None, **kwargs):
+        """Login to server, tuning transfers of this instance with a profile and bandwidth limit, see ssh.Tuning."""
+        self.logout()
         logging.getLogger('ipyslurm.slurm').debug(f'Logging in to {username}@{server}')
-        self.ssh = ssh.SSH(server, username, password, **kwargs)
+        tuning = ssh.Tuning(profile, limit)
+        self.ssh = ssh.connect(server, username, password, profile=profile, **kwargs)
+        self.tuning = tuning
 
     def logout(self):
         if self.ssh is not None:
             logging.getLogger('ipyslurm.slurm').debug(f'Logging out of {self.ssh.server}')
+            ssh.disconnect(self.ssh)
             self.ssh = None
+            self.tracker = tracker.JobTracker(self)
+            self.tuning = None
+            self._details = {}
+            self._history = None
+            self._sftp = None
+
+    def open(self, path, **kwargs):  # noqa: A003
+        """Open a remote file for random access, fetching only the blocks that are read, see sftp.RemoteFile."""
+        self._verify_login()
+        client = self._sftp_client()
+        client.expand([path])
+        return client.open(path, **kwargs)
 
     def sbatch(self, lines, args=None):
+        return self.sbatch_many([lines], args)[0]
+
+    @metrics.timed('sbatch')
+    def sbatch_many(self, scripts, args=None, error=True):
+        """Submit batch scripts in as few commands as possible and return their job IDs.
+
+        Scripts are given as lines, or as (lines, args) pairs with arguments specific to that job.
+        Failed submissions raise a RuntimeError naming each failed script, or are returned as None if error is False.
+        """
         self._verify_login()
-        if isinstance(lines, str):
-            lines = lines.splitlines()
-        if args is None:
-            args = []
-        elif isinstance(args, str):
-            args = shlex.split(args, posix=False)
-        args = ' '.join(list(args) + [x.replace('#SBATCH', '').strip() for x in lines if x.startswith('#SBATCH')])
-        lines = [x.replace("'", "'\"'\"'") for x in lines if not x.startswith('#SBATCH')]
-        shebangs = [i for i, x in enumerate(lines) if x.startswith('#!')]
-        command = lines[:shebangs[0]] if shebangs else lines
-        for i, j in zip(shebangs, shebangs[1:] + [None]):
-            script = '\n'.join(lines[slice(i, j)])
-            command_init = [
-                'SCRIPT=$(mktemp)',
-                f"echo '{script}' > $SCRIPT",
-                'chmod +x $SCRIPT',
-                'echo $SCRIPT']
-            command += self.ssh.exec_command(command_init)
-        command_args = [x.group(1) for x in re.finditer('\\{(.+?)\\}', args)]
-        if command_args:
-            stdouts = self.ssh.exec_command(command_args)
-            for stdout in stdouts:
-                args = re.sub('\\{(.+?)\\}', stdout, args, count=1)
-        if lines:
-            command = ["sbatch {} --wrap='{}'".format(args, '\n'.join(command))]  # noqa: FS002
-        else:
-            command = [f'sbatch {args}']
-        stdouts = self.ssh.exec_command(command)
-        if not stdouts or not stdouts[-1].startswith('Submitted batch job '):
-            raise RuntimeError('\n'.join(stdouts))
-        logging.getLogger('ipyslurm.slurm').debug(stdouts[-1])
-        return int(stdouts[-1].split()[-1])
+        separator = '<<< ipyslurm sbatch separator >>>'
+        submissions = []
+        for script in scripts:
+            lines, args_ = script if isinstance(script, tuple) else (script, None)
+            if isinstance(lines, str):
+                lines = lines.splitlines()
+            args_ = _args(args) + _args(args_) + [x.replace('#SBATCH', '').strip() for x in lines if x.startswith('#SBATCH')]
+            submissions.append((args_, *_split_scripts([x for x in lines if not x.startswith('#SBATCH')])))
+        scripts = list(dict.fromkeys(y for x in submissions for y in x[2]))
+        paths = dict(zip(scripts, self._sftp_client().upload(scripts))) if scripts else {}
+        commands = ['\n'.join([f'echo "{separator}"'] + self._sbatch(lines, args_, [paths[x] for x in scripts_])) for args_, lines, scripts_ in submissions]
+        stdouts = []
+        for chunk in _chunks(commands):
+            stdouts += self.ssh.exec_command(chunk, error=False)
+        outputs = util.split_list(stdouts, separator)[1:]
+        if len(outputs) != len(submissions):
+            raise RuntimeError(f'Failed to attribute output of {len(outputs)} to {len(submissions)} submission(s):\n' + '\n'.join(stdouts))
+        jobs, errors = [], []
+        for i, output in enumerate(outputs):
+            if output and output[-1].startswith('Submitted batch job '):
+                logging.getLogger('ipyslurm.slurm').debug(output[-1])
+                jobs.append(int(output[-1].split()[-1]))
+            else:
+                errors.append(f'[{i}]: ' + '\n'.join(output))
+                jobs.append(None)
+        if errors:
+            message = f'Failed to submit {len(errors)} of {len(jobs)} job(s):\n' + '\n'.join(errors)
+            if error:
+                raise RuntimeError(message)
+            logging.getLogger('ipyslurm.slurm').warning(message)
+        return jobs
 
     def scancel(self, job):
         self.command(f'scancel {job}')
 
     def scontrol_show_job(self, job):
-        stdouts = self.ssh.exec_command(f'scontrol show job {job} --details')
-        details = util.split_list(stdouts, separator='')[:-1]
-        details = [re.split(r'\s*(\w+)=', ' '.join(x)) for x in details]
-        details = [dict([x[i:i+2] for i in range(1, len(x), 2)]) for x in details]
-        return sorted(details, key=lambda x: int(x['ArrayTaskId']) if 'ArrayTaskId' in x and x['ArrayTaskId'].isnumeric() else 0)
+        return self._scontrol_show_job(job).dicts()
 
     @property
     def server(self):
         return self.ssh.server if self.ssh is not None else None
 
-    def sftp(self, lines):
+    def sftp(self, lines, workers=1, profile=None, limit=None):
+        """Execute SFTP commands, optionally with a tuning profile and bandwidth limit that apply to this transfer only, see ssh.Tuning."""
         self._verify_login()
         if isinstance(lines, str):
             lines = lines.splitlines()
         lines = [x for x in lines if x.strip() and not x.lstrip().startswith('#')]
-        ftp = sftp.SFTP(self.ssh)
-        ftp.exec_commands(lines)
+        client = self._sftp_client()
+        client.ftp.chdir(None)  # each call starts in the home directory, even though the session is reused
+        with client.tuned(profile, limit):
+            client.workers = workers
+            client.exec_commands(lines)
 
     def squeue(self, output_format=None):
         if output_format is None:
             output_format = '%.20j %.15i %.7M %.10l %.7u %.9P %.8T %R'
         print(self.command(f'squeue --format "{output_format}"'))
 
-    def tail(self, job, lines=1, repeat=True, clear=True):
-        separator = '<<< ipyslurm job output separator >>>'
+    def stats(self, reset=False):
+        """Return counters of round trips and bytes, and latency histograms of operations, collected process-wide while enabled, see ipyslurm.stats."""
+        snapshot = metrics.snapshot()
+        if reset:
+            metrics.reset()
+        return snapshot
+
+    def tail(self, job, lines=1, repeat=True, clear=True, follow=False, interval=1, max_interval=30):
+        """Print the last lines of the output of pending or running jobs, repeating until they are complete.
+
+        With follow, only bytes appended since the previous poll are fetched, and jobs are no longer polled once complete.
+        Polling waits interval seconds, doubling up to max_interval while there is no new output.
+        """
+        if follow:
+            self._follow(job, lines or 0, interval, max_interval)
+            return
+        previous, delay = None, interval
         while True:
-            details = self.scontrol_show_job(job)
-            filepaths = ' '.join(f'{x["StdOut"]}' for x in details)
-            stdouts = self.ssh.exec_command(f"""
+            output, active = self._tail(job, lines)
+            if lines is not None and output != previous:
+                if clear:
+                    clear_output(wait=True)
+                print(output, end='', flush=True)
+            if not repeat or not active:
+                break
+            delay = interval if output != previous else min(2 * delay, max_interval)
+            previous = output
+            time.sleep(delay)
+
+    def writefile(self, filepath, lines, append=False):
+        self._verify_login()
+        if isinstance(lines, str):
+            lines = lines.splitlines()
+        client = self._sftp_client()
+        client.expand([filepath])
+        with client.ftp.open(client.normalize(filepath, client.home), 'ab' if append else 'wb') as f:
+            f.write(''.join(f'{x}\n' for x in lines).encode())
+
+    def _command(self, lines):
+        if isinstance(lines, str):
+            lines = lines.splitlines()
+        command, scripts = _split_scripts(lines)
+        return command + ([shlex.quote(x) for x in self._sftp_client().upload(scripts)] if scripts else [])
+
+    def _follow(self, job, lines, interval, max_interval):
+        offsets, partials, states = {}, {}, {}
+        delay = interval
+        while True:
+            details = [x for x in self._job_details(job) if x['JobId'] in offsets or x['JobState'] in tracker.ACTIVE_STATES]
+            command = []
+            for detail in details:
+                filepath, offset = shlex.quote(detail['StdOut']), offsets.get(detail['JobId'])
+                if offset is None:
+                    command.append(f'if [ -f {filepath} ]; then stat -c %s {filepath}; tail -n {lines} {filepath} | base64 -w 0; echo; else echo 0; echo; fi')
+                else:
+                    command.append(f'if [ -f {filepath} ]; then size=$(stat -c %s {filepath}); echo $size; [ $size -ge {offset} ] && tail -c +{offset + 1} {filepath} | head -c $((size - {offset})) | base64 -w 0; echo; else echo 0; echo; fi')
+            stdouts = []
+            for chunk in _chunks(command):
+                stdouts += self.ssh.exec_command(chunk)
+            changed = False
+            for detail, size, data in zip(details, stdouts[::2], stdouts[1::2]):
+                jobname = detail['JobName']
+                if 'ArrayTaskId' in detail:
+                    jobname = f'{jobname} [{detail["ArrayTaskId"]}]'  # noqa: Q000
+                if int(size) < offsets.get(detail['JobId'], 0):
+                    partials[detail['JobId']] = b''  # truncated
+                offsets[detail['JobId']] = int(size)
+                *outputs, partials[detail['JobId']] = (partials.get(detail['JobId'], b'') + base64.b64decode(data)).replace(b'\r', b'\n').split(b'\n')
+                if detail['JobState'] not in tracker.ACTIVE_STATES:
+                    outputs.append(partials.pop(detail['JobId']))
+                    del offsets[detail['JobId']]
+                for output in outputs:
+                    if output:
+                        print(f'{jobname}: {output.decode(errors="replace")}', flush=True)
+                if states.get(detail['JobId']) != detail['JobState']:
+                    print(f'{jobname}: {detail["JobState"]}', flush=True)  # noqa: Q000
+                    states[detail['JobId']] = detail['JobState']
+                    changed = True
+                changed = changed or bool(outputs)
+            if not offsets:
+                break
+            delay = interval if changed else min(2 * delay, max_interval)
+            time.sleep(delay)
+
+    def _job_details(self, job):
+        records = self.tracker.records(job)
+        details = self._details.get(str(job))
+        if details is None or {x['JobId'] for x in records}.difference(details.column('JobId')):
+            details = self._details[str(job)] = self._scontrol_show_job(job)
+        states = {x['JobId']: x['JobState'] for x in records}
+        jobids, jobstates = details.column('JobId'), details.column('JobState')
+        for i, jobid in enumerate(jobids):
+            jobstates[i] = states.get(jobid, jobstates[i])
+        return details
+
+    def _sbatch(self, lines, args, paths):
+        """Return a command that submits a job, failing without submitting if a {command} substituted into its arguments fails."""
+        substitutions = []
+
+        def substitute(match):
+            message = shlex.quote(f'Failed to evaluate {{{match.group(1)}}}')
+            substitutions.append(f'ipyslurm_{len(substitutions)}=$({match.group(1)}) || {{ echo {message}; exit 1; }}')
+            return f'$ipyslurm_{len(substitutions) - 1}'
+        args = re.sub('\\{(.+?)\\}', substitute, ' '.join(args))
+        command = [x.replace("'", "'\"'\"'") for x in lines + [shlex.quote(x) for x in paths]]
+        if command:
+            command = ["sbatch {} --wrap='{}'".format(args, '\n'.join(command))]  # noqa: FS002
+        else:
+            command = [f'sbatch {args}']
+        return ['('] + substitutions + command + [') 2>&1']
+
+    def _scontrol_show_job(self, job):
+        stdouts = self.ssh.exec_command(f'scontrol show job {job} --details --oneliner')
+        return tracker.JobTable.from_scontrol(stdouts)
+
+    def _sftp_client(self):
+        channel = self._sftp.ftp.get_channel() if self._sftp is not None else None
+        if channel is None or channel.closed or channel.get_transport() is not self.ssh.get_transport():
+            self._sftp = sftp.SFTP(self.ssh, tuning=self.tuning)
+        return self._sftp
+
+    def _stream(self, lines, start):
+        """Yield lines of a command stream, recording the latency of the command once the stream is exhausted."""
+        try:
+            for _, line in lines:
+                yield line
+        finally:
+            metrics.observe('command', time.perf_counter() - start)
+
+    @metrics.timed('tail')
+    def _tail(self, job, lines=1):
+        separator = '<<< ipyslurm job output separator >>>'
+        details = self._job_details(job)
+        filepaths = ' '.join(f'{x["StdOut"]}' for x in details)
+        stdouts = self.ssh.exec_command(f"""
 filepaths="{filepaths}"
 for filepath in $filepaths; do
     if [ -f "$filepath" ]; then
@@ -130,33 +349,55 @@ for filepath in $filepaths; do
     echo "{separator}"
 done
 """)
-            stdouts = util.split_list(stdouts, separator)[:-1]
-            if lines == 0:
-                stdouts = [[]] * len(stdouts)
-            output = ''
-            for i, detail in enumerate(details):
-                if detail['JobState'] not in ('PENDING', 'RUNNING'):
-                    continue
-                jobname = detail['JobName']
-                if 'ArrayTaskId' in detail:
-                    jobname = f'{jobname} [{detail["ArrayTaskId"]}]'  # noqa: Q000
-                for stdout in stdouts[i]:
-                    output += f'{jobname}: {stdout}\n'
-                if not stdouts[i]:
-                    output += f'{jobname}: {detail["JobState"]}\n'  # noqa: Q000
-            if lines is not None:
-                if clear:
-                    clear_output(wait=True)
-                print(output, end='', flush=True)
-            if not repeat or all(x['JobState'] not in ('PENDING', 'RUNNING') for x in details):
-                break
-
-    def writefile(self, filepath, lines, append=False):
-        if isinstance(lines, str):
-            lines = lines.splitlines()
-        redirect = '>>' if append else '>'
-        self.command([f'cat << \\EOF {redirect} {filepath}'] + lines + ['EOF'])
+        stdouts = util.split_list(stdouts, separator)[:-1]
+        if lines == 0:
+            stdouts = [[]] * len(stdouts)
+        output = ''
+        for i, detail in enumerate(details):
+            if detail['JobState'] not in ('PENDING', 'RUNNING'):
+                continue
+            jobname = detail['JobName']
+            if 'ArrayTaskId' in detail:
+                jobname = f'{jobname} [{detail["ArrayTaskId"]}]'  # noqa: Q000
+            for stdout in stdouts[i]:
+                output += f'{jobname}: {stdout}\n'
+            if not stdouts[i]:
+                output += f'{jobname}: {detail["JobState"]}\n'  # noqa: Q000
+        return output, any(x['JobState'] in ('PENDING', 'RUNNING') for x in details)
 
     def _verify_login(self):
         if self.ssh is None:
             raise AuthenticationException('Not logged in to a server')
+
+
+def _args(args):
+    if args is None:
+        return []
+    if isinstance(args, str):
+        return shlex.split(args, posix=False)
+    return list(args)
+
+
+def _chunks(commands, size=COMMAND_SIZE):
+    """Group commands into chunks that stay within the length of a single command, which is capped by the kernel for each argument."""
+    chunk, total = [], 0
+    for command in commands:
+        if chunk and total + len(command) > size:
+            yield chunk
+            chunk, total = [], 0
+        chunk.append(command)
+        total += len(command) + 1
+    if chunk:
+        yield chunk
+
+
+def _relative(path, directory):
+    if directory and path.startswith(f'{directory.rstrip("/")}/'):
+        return posixpath.relpath(path, directory)
+    return path.lstrip('/')
+
+
+def _split_scripts(lines):
+    shebangs = [i for i, x in enumerate(lines) if x.startswith('#!')]
+    command = lines[:shebangs[0]] if shebangs else lines
+    return command, [''.join(f'{x}\n' for x in lines[slice(i, j)]) for i, j in zip(shebangs, shebangs[1:] + [None])]
@@ -1,18 +1,103 @@
+import codecs
+import collections
+import contextlib
 import getpass
 import logging
+import queue
+import select
 import threading
 import time
+import uuid
 
 import paramiko
 from IPython.display import display
 
+from . import stats as metrics
+from .util import parse_size
+
+AUTO_BANDWIDTH = 2 ** 27
+AUTO_WINDOW_SIZE = 2 ** 28
+PROFILES = {
+    'default': {'compress': False, 'max_packet_size': 2 ** 15, 'window_size': 2 ** 21},
+    'lan': {'compress': False, 'max_packet_size': 2 ** 17, 'window_size': 2 ** 24},
+    'vpn': {'compress': True, 'max_packet_size': 2 ** 15, 'window_size': 2 ** 22},
+    'wan': {'compress': False, 'max_packet_size': 2 ** 17, 'window_size': 2 ** 27}}
+SHELL_FRAME_RATE = 20
+SHELL_POLL = 0.5
+SHELL_SCROLLBACK = 2 ** 20
+
+_pending = object()
+_pool = {}
+_pool_lock = threading.Condition(threading.RLock())
+
+
+def command_error(command, status, stdouts=(), stderrs=()):
+    message = f'Command returned with exit code {status}:'
+    message += f'\nstdin: "{command}"'
+    if stdouts:
+        message += '\nstdout: "{}"'.format('\n'.join(stdouts))  # noqa: FS002
+    if stderrs:
+        message += '\nstderr: "{}"'.format('\n'.join(stderrs))  # noqa: FS002
+    return RuntimeError(message)
+
+
+def connect(server, username, password=None, **kwargs):
+    """Return a connection to server shared within the process, authenticating only if none is available.
+
+    Authentication, which may be interactive, happens outside the lock of the pool, while concurrent requests for the same connection wait for it.
+    """
+    key = server, username
+    with _pool_lock:
+        while _pool.get(key, (None, 0))[0] is _pending:
+            _pool_lock.wait()
+        client, references = _pool.get(key, (None, 0))
+        _pool[key] = _pending if client is None else client, references + 1
+    if client is not None:
+        client.reconnect()
+        client.persistent = client.persistent or kwargs.get('persistent', False)
+        return client
+    try:
+        client = SSH(server, username, password, **kwargs)
+    except BaseException:
+        with _pool_lock:
+            del _pool[key]
+            _pool_lock.notify_all()
+        raise
+    with _pool_lock:
+        _pool[key] = client, _pool[key][1]
+        _pool_lock.notify_all()
+    return client
+
+
+def disconnect(client):
+    """Release a shared connection, closing it once it is no longer used."""
+    with _pool_lock:
+        for key, (client_, references) in list(_pool.items()):
+            if client_ is client:
+                if references > 1:
+                    _pool[key] = client, references - 1
+                    client = None
+                else:
+                    del _pool[key]
+                break
+        else:
+            client = None
+    if client is not None:
+        client.close()
+
 
 class SSH(paramiko.SSHClient):
 
     def __init__(self, *args, **kwargs):
         super().__init__()
         self.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.persistent = False
         self.server = None
+        self._connection = None
+        self._reconnect_lock = threading.Lock()
+        self._sessions = collections.defaultdict(queue.SimpleQueue)
+        self._shell = None
+        self._shell_lock = threading.Lock()
         if len(args) or len(kwargs):
             self.connect(*args, **kwargs)
 
@@ -20,13 +105,18 @@ class SSH(paramiko.SSHClient):
         self.close()
 
     def close(self):
+        for sessions in self._sessions.values():
+            while not sessions.empty():
+                sessions.get().close()
+        self._shell = None
         super().close()
         self.server = None
 
-    def connect(self, server, username, password=None, keepalive=30, **kwargs):
+    def connect(self, server, username, password=None, keepalive=30, persistent=False, profile='auto', **kwargs):
+        """Connect to server, compressing the connection if the tuning profile asks for it, see Tuning."""
         self.close()
         try:
-            super().connect(server, username=username, **kwargs)
+            super().connect(server, username=username, **dict({'compress': PROFILES.get(profile, {}).get('compress', False)}, **kwargs))
         except paramiko.SSHException:
             try:
                 def handler(title, instructions, prompt_list):
@@ -49,25 +139,44 @@ class SSH(paramiko.SSHClient):
                     password = getpass.getpass('Password:')
                 self._transport.auth_password(username, password)
         self._transport.set_keepalive(keepalive)
+        self.persistent = persistent
         self.server = server
+        self._connection = server, username, password, keepalive, dict(kwargs, persistent=persistent, profile=profile)
 
-    def exec_command(self, command, block=True, error=True, **kwargs):
+    def exec_command(self, command, block=True, error=True, stream=False, **kwargs):
+        self.reconnect()
         if not isinstance(command, str):
             command = '\n'.join(command)
         if command:
             logging.getLogger('ipyslurm.ssh').debug(f'stdin: "{command}"')
-        _, stdout, stderr = super().exec_command(command, **kwargs)
-        status = stdout.channel.recv_exit_status() if block else -1
-        stdouts = [x.strip('\n') for x in stdout]
-        stderrs = [x.strip('\n') for x in stderr]
+        metrics.count('commands')
+        if metrics.enabled:
+            metrics.count('bytes_sent', len(command.encode()))
+        if stream:
+            _, stdout, _ = super().exec_command(command, **kwargs)
+            metrics.count('exec_channels')
+            return CommandStream(stdout.channel, command, error)
+        if self.persistent and block and not kwargs and self._shell_lock.acquire(blocking=False):
+            try:
+                if self._shell is None or self._shell.channel.closed:
+                    self._shell = Shell(self._transport)
+                status, stdouts, stderrs = self._shell.exec_command(command)
+            except BaseException:
+                # e.g., KeyboardInterrupt, after which the output of the command would leak into the next one
+                self._shell.channel.close()
+                self._shell = None
+                raise
+            finally:
+                self._shell_lock.release()
+        else:
+            _, stdout, _ = super().exec_command(command, **kwargs)
+            metrics.count('exec_channels')
+            stdouts, stderrs = [], []
+            for name, line in LineReader(stdout.channel):
+                (stdouts if name == 'stdout' else stderrs).append(line)
+            status = stdout.channel.recv_exit_status() if block else -1
         if error and status > 0:
-            message = f'Command returned with exit code {status}:'
-            message += f'\nstdin: "{command}"'
-            if stdouts:
-                message += '\nstdout: "{}"'.format('\n'.join(stdouts))  # noqa: FS002
-            if stderrs:
-                message += '\nstderr: "{}"'.format('\n'.join(stderrs))  # noqa: FS002
-            raise RuntimeError(message)
+            raise command_error(command, status, stdouts, stderrs)
         for stdout in stdouts:
             logging.getLogger('ipyslurm.ssh').debug(f'stdout: "{stdout}"')
         for stderr in stderrs:
@@ -76,30 +185,292 @@ class SSH(paramiko.SSHClient):
 
     def invoke_shell(self, **kwargs):
         import ipywidgets
+        self.reconnect()
         channel = super().invoke_shell(**kwargs)
         output = ipywidgets.Output()
         stdin = ipywidgets.widgets.Text(placeholder='Enter shell command')
         display(ipywidgets.VBox((output, stdin)))
+        clear = threading.Event()
 
-        def writeall(channel_, output_):
+        def read():
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            scrollback, size, pending, deadline = collections.deque(), 0, [], None
             while True:
-                stdout = paramiko.py3compat.u(channel_.recv(1024))
-                if stdout:
-                    output_.append_stdout(stdout)
-        writer = threading.Thread(target=writeall, args=(channel, output))
-        writer.start()
+                readable, _, _ = select.select((channel,), (), (), SHELL_POLL if deadline is None else max(deadline - time.monotonic(), 0))
+                closed = channel.closed
+                if readable and not closed:
+                    data = channel.recv(2 ** 16)
+                    closed = not data
+                    if data:
+                        pending.append(decoder.decode(data))
+                        deadline = deadline or time.monotonic() + 1 / SHELL_FRAME_RATE
+                if pending and (closed or time.monotonic() >= deadline):
+                    text = ''.join(pending)
+                    pending, deadline = [], None
+                    if clear.is_set() and '\n' in text:  # keep what follows the echoed clear command, i.e., the prompt
+                        clear.clear()
+                        text = text.rpartition('\n')[2]
+                        scrollback.clear()
+                        size = 0
+                        output.outputs = ()
+                    scrollback.append(text[-SHELL_SCROLLBACK:])
+                    size += len(scrollback[-1])
+                    if size > SHELL_SCROLLBACK:
+                        while len(scrollback) > 1 and size > SHELL_SCROLLBACK // 2:
+                            size -= len(scrollback.popleft())
+                        output.outputs = ({'output_type': 'stream', 'name': 'stdout', 'text': ''.join(scrollback)},)
+                    else:
+                        output.append_stdout(text)
+                if closed:
+                    stdin.close()
+                    return
+        threading.Thread(target=read, daemon=True).start()
 
         def callback(widget):
             if widget.value in ('exit', 'quit', 'q'):
-                writer.join(0)
                 channel.close()
-                stdin.close()
             else:
+                if widget.value == 'clear':
+                    clear.set()
                 channel.send(f'{widget.value}\n')
-            if widget.value == 'clear':
-                lastline = output.outputs[-1]['text'].splitlines()[-1]
-                time.sleep(0.1)
-                output.outputs = ()
-                output.append_stdout(lastline)
             widget.value = ''
         stdin.on_submit(callback)
+
+    def is_active(self):
+        return self._transport is not None and self._transport.is_authenticated()
+
+    def measure_rtt(self):
+        """Return the round-trip time to the server in seconds, measured with a keepalive request."""
+        start = time.perf_counter()
+        self._transport.global_request('keepalive@openssh.com', wait=True)
+        return time.perf_counter() - start
+
+    def open_sftp(self, window_size=None, max_packet_size=None):
+        self.reconnect()
+        return SFTPClient.from_transport(self._transport, window_size, max_packet_size)
+
+    def reconnect(self):
+        """Reconnect using the original credentials if the transport was closed, e.g., after keepalive failures.
+
+        Threads that find the transport closed at the same time wait for a single reconnection.
+        """
+        if self._connection is not None and not self.is_active():
+            with self._reconnect_lock:
+                if not self.is_active():
+                    server, username, password, keepalive, kwargs = self._connection
+                    logging.getLogger('ipyslurm.ssh').debug(f'Reconnecting to {username}@{server}')
+                    self.connect(server, username, password, keepalive, **kwargs)
+
+    @contextlib.contextmanager
+    def session(self, window_size=None, max_packet_size=None):
+        """Borrow an idle SFTP session with the given window and packet sizes on this transport, opening a new one if needed."""
+        sessions = self._sessions[window_size, max_packet_size]
+        ftp = None
+        while ftp is None and not sessions.empty():
+            ftp = sessions.get_nowait()
+            if ftp.sock.closed:
+                ftp = None
+        if ftp is None:
+            ftp = self.open_sftp(window_size, max_packet_size)
+        try:
+            yield ftp
+        except OSError:
+            raise  # e.g., a missing file, which leaves the session usable
+        except BaseException:
+            ftp.close()
+            raise
+        finally:
+            if not ftp.sock.closed and ftp.sock.get_transport() is self._transport:
+                sessions.put(ftp)
+
+
+class Tuning:
+    """Window and packet sizes of SFTP channels and a bandwidth limit of transfers.
+
+    Tuning is kept per client rather than on the connection, which is shared within the process, see connect.
+    Profiles are listed in PROFILES, where compression only takes effect when connecting.
+    With the auto profile, the window size is derived from the measured round-trip time and grown while transfers are limited by it.
+    """
+
+    def __init__(self, profile='auto', limit=None, rtt=None):
+        if profile != 'auto' and profile not in PROFILES:
+            raise ValueError(f'Unknown profile "{profile}", expected one of auto, {", ".join(PROFILES)}')  # noqa: Q000
+        settings = PROFILES.get(profile, PROFILES['default'])
+        self.limit = parse_size(limit) or None if limit is not None else None
+        self.max_packet_size = settings['max_packet_size']
+        self.profile = profile
+        self.rtt = rtt
+        self.throughput = None
+        self.window_size = settings['window_size']
+        self._allowance = (0, time.monotonic())
+        self._lock = threading.Lock()
+        self._meter = (0, time.monotonic(), time.monotonic())
+
+    def measure(self, ssh):
+        """Derive the window size of the auto profile from the round-trip time to the server, measured once."""
+        if self.profile == 'auto':
+            if self.rtt is None:
+                self.rtt = ssh.measure_rtt()
+                logging.getLogger('ipyslurm.ssh').debug(f'Measured round-trip time of {1000 * self.rtt:.1f} ms')
+            self.window_size = min(max(int(self.rtt * AUTO_BANDWIDTH), PROFILES['default']['window_size']), AUTO_WINDOW_SIZE)
+        return self
+
+    def throttle(self, size):
+        """Account for size bytes transferred, measuring throughput and sleeping as needed to stay within the bandwidth limit."""
+        now, delay = time.monotonic(), 0
+        with self._lock:
+            count, start, last = self._meter
+            if now - last > 1:
+                count, start = 0, now  # idle
+            count += size
+            if now - start >= 1:
+                self.throughput = count / (now - start)
+                count, start = 0, now
+                if self.profile == 'auto' and self.rtt:
+                    self._autotune()
+            self._meter = count, start, now
+            if self.limit:
+                allowance, allowed = self._allowance
+                allowance = min(self.limit, allowance + (now - allowed) * self.limit) - size
+                self._allowance = allowance, now
+                delay = -allowance / self.limit if allowance < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def _autotune(self):
+        if self.window_size < AUTO_WINDOW_SIZE and self.throughput > self.window_size / self.rtt / 2:
+            self.window_size = min(2 * self.window_size, AUTO_WINDOW_SIZE)
+            logging.getLogger('ipyslurm.ssh').debug(f'Increased window size to {self.window_size} at {self.throughput:.0f} B/s')
+
+
+class Shell:
+    """Long-lived remote shell that runs each command in a subshell and frames its output with sentinel markers.
+
+    Avoids opening a new channel and starting a new shell for every command, see SSH.exec_command.
+    """
+
+    def __init__(self, transport):
+        self.channel = transport.open_session()
+        self.channel.exec_command('exec bash -s')
+        metrics.count('exec_channels')
+        self.lines = iter(LineReader(self.channel))
+
+    def exec_command(self, command):
+        marker = f'IPYSLURM_{uuid.uuid4().hex}'
+        self.channel.sendall('\n'.join((
+            f"IFS= read -r -d '' IPYSLURM_COMMAND << '{marker}'",
+            command,
+            marker,
+            '(eval "$IPYSLURM_COMMAND") < /dev/null',
+            f'echo "{marker} $?"',
+            f'echo "{marker}" >&2',
+            '')).encode())
+        status, stdouts, stderrs = None, [], []
+        markers = set()
+        for name, line in self.lines:
+            lines = stdouts if name == 'stdout' else stderrs
+            if marker in line:
+                line, _, remainder = line.partition(marker)
+                if line:
+                    lines.append(line)
+                if name == 'stdout':
+                    status = int(remainder)
+                markers.add(name)
+                if len(markers) == 2:
+                    break
+            else:
+                lines.append(line)
+        else:
+            # the shell exited, e.g., due to exec or kill, whose exit status may follow end of file
+            self.channel.status_event.wait(1)
+            status = self.channel.exit_status if self.channel.exit_status_ready() else -1
+            self.channel.close()
+        return status, stdouts, stderrs
+
+
+class CommandStream:
+    """Iterate over (stream, line) of a remote command as lines arrive, see LineReader.
+
+    The exit status is available once the iteration is complete, and a nonzero exit status raises unless error is False.
+    """
+
+    def __init__(self, channel, command, error=True):
+        self.channel = channel
+        self.command = command
+        self.error = error
+        self.status = None
+
+    def __iter__(self):
+        for name, line in LineReader(self.channel):
+            logging.getLogger('ipyslurm.ssh').debug(f'{name}: "{line}"')
+            yield name, line
+        self.status = self.channel.recv_exit_status()
+        if self.error and self.status > 0:
+            raise command_error(self.command, self.status)
+
+
+class LineReader:
+    """Iterate over (stream, line) of a channel as lines arrive on stdout and stderr, until both reach end of file.
+
+    Only partial lines are buffered, and data is received only as lines are consumed, which keeps memory bounded and lets the channel window apply backpressure.
+    """
+
+    def __init__(self, channel, size=32768):
+        self.channel = channel
+        self.size = size
+
+    def __iter__(self):
+        buffers = {'stdout': b'', 'stderr': b''}
+        streams = (
+            ('stdout', self.channel.recv_ready, self.channel.recv),
+            ('stderr', self.channel.recv_stderr_ready, self.channel.recv_stderr))
+        while True:
+            if not self.channel.recv_ready() and not self.channel.recv_stderr_ready():
+                if self.channel.eof_received or self.channel.closed:
+                    break
+                select.select([self.channel], [], [], 1)
+                continue
+            for name, ready, recv in streams:
+                if ready():
+                    data = recv(self.size)
+                    metrics.count('bytes_received', len(data))
+                    buffers[name] += data
+                    *lines, buffers[name] = buffers[name].split(b'\n')
+                    for line in lines:
+                        yield name, line.decode(errors='replace')
+        for name, buffer in buffers.items():
+            if buffer:
+                yield name, buffer.decode(errors='replace')
+
+
+class SFTPClient(paramiko.SFTPClient):
+    """SFTP client that counts its requests, see ipyslurm.stats."""
+
+    def stat_many(self, paths):
+        """Return attributes of paths, with None for those that do not exist, sending all requests before waiting for any response."""
+        responses = _Responses()
+        requests = [self._async_request(responses, paramiko.sftp.CMD_STAT, self._adjust_cwd(x)) for x in paths]
+        while len(responses) < len(requests):
+            self._read_response()
+        attributes = []
+        for request in requests:
+            t, msg = responses[request]
+            if t == paramiko.sftp.CMD_STATUS:
+                try:
+                    self._convert_status(msg)
+                except FileNotFoundError:
+                    attributes.append(None)
+                    continue
+            attributes.append(paramiko.SFTPAttributes._from_msg(msg))
+        return attributes
+
+    def _async_request(self, fileobj, t, *args):
+        metrics.count('sftp_requests')
+        return super()._async_request(fileobj, t, *args)
+
+
+class _Responses(dict):
+    """Responses of pipelined SFTP requests by request number."""
+
+    def _async_response(self, t, msg, num):
+        self[num] = t, msg
@@ -0,0 +1,151 @@
+"""Process-wide counters and latency histograms of remote operations.
+
+Collection is disabled by default, in which case count and timer return after checking a single flag.
+"""
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100)
+
+enabled = False
+_counters = collections.Counter()
+_exporters = []
+_histograms = {}
+_lock = threading.Lock()
+_null = contextlib.nullcontext()
+
+
+class Histogram:
+    """Latency distribution in seconds over the upper bounds in BUCKETS, with a final bucket for anything slower."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.maximum = 0
+        self.minimum = None
+        self.total = 0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.maximum = max(self.maximum, seconds)
+        self.minimum = seconds if self.minimum is None else min(self.minimum, seconds)
+        self.total += seconds
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in, capped by the maximum."""
+        rank, cumulative = q * self.count, 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0,
+            'min': self.minimum or 0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': self.maximum,
+            'buckets': dict(zip((*BUCKETS, float('inf')), self.buckets))}
+
+
+def add_exporter(exporter):
+    """Call exporter(kind, name, value) for each counter increment and latency observation while enabled.
+
+    kind is count or latency, which maps onto counters and histograms of exporters such as OpenTelemetry or Prometheus clients.
+    """
+    with _lock:
+        _exporters.append(exporter)
+
+
+def count(name, value=1):
+    """Increment a counter, e.g., of round trips or bytes."""
+    if enabled:
+        with _lock:
+            _counters[name] += value
+        _export('count', name, value)
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def observe(name, seconds):
+    """Record the latency of an operation in seconds."""
+    if enabled:
+        with _lock:
+            histogram = _histograms.get(name)
+            if histogram is None:
+                histogram = _histograms[name] = Histogram()
+            histogram.observe(seconds)
+        _export('latency', name, seconds)
+
+
+def remove_exporter(exporter):
+    with _lock:
+        _exporters.remove(exporter)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def snapshot():
+    """Return counters and summaries of latency histograms collected so far."""
+    with _lock:
+        return {
+            'enabled': enabled,
+            'counters': dict(sorted(_counters.items())),
+            'latency': {name: x.summary() for name, x in sorted(_histograms.items())}}
+
+
+def timer(name):
+    """Return a context manager that records the latency of its body, see observe."""
+    return _timer(name) if enabled else _null
+
+
+def timed(name):
+    """Decorate a function to record its latency, see timer."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def _timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def _export(kind, name, value):
+    for exporter in _exporters:
+        try:
+            exporter(kind, name, value)
+        except Exception as e:
+            logging.getLogger('ipyslurm.stats').warning(f'Failed to export {kind} of {name}: {e}')
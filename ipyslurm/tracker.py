@@ -0,0 +1,212 @@
+import collections.abc
+import logging
+import re
+import threading
+import time
+import weakref
+
+ACTIVE_STATES = (
+    'COMPLETING',
+    'CONFIGURING',
+    'PENDING',
+    'REQUEUED',
+    'RESIZING',
+    'RUNNING',
+    'SUSPENDED')
+SACCT_FORMAT = 'JobIDRaw,JobID,State,Elapsed,Partition,User,JobName'
+SQUEUE_FORMAT = '%A|%F|%K|%T|%r|%M|%P|%u|%j'
+
+_FIELD = re.compile(r'\s([\w:/]+)=')
+_FIELD_END = re.compile(r'\s+[\w:/]+=')
+_FIELD_SPLIT = re.compile(r'\s+([\w:/]+)=')
+
+
+class JobRecord(collections.abc.MutableMapping):
+    """A single record of a JobTable, reading and writing its columns."""
+
+    __slots__ = ('_index', '_table')
+
+    def __init__(self, table, index):
+        self._index = index
+        self._table = table
+
+    def __delitem__(self, key):
+        column = self._table.column(key)
+        if column[self._index] is None:
+            raise KeyError(key)
+        column[self._index] = None
+
+    def __getitem__(self, key):
+        column = self._table._columns.get(key)
+        value = (column if column is not None else self._table.column(key))[self._index]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        keys = dict.fromkeys(_FIELD.findall(self._table._records[self._index]))
+        keys.update(dict.fromkeys(self._table._columns))
+        return (x for x in keys if self._table.column(x)[self._index] is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __setitem__(self, key, value):
+        self._table.column(key)[self._index] = value
+
+
+class JobTable(collections.abc.Sequence):
+    """Job records parsed from scontrol output.
+
+    Records are kept as raw lines, and each field is extracted into a column only when first accessed, so that large job arrays are parsed in a single pass over the fields that are actually used.
+    """
+
+    def __init__(self, records=()):
+        self._columns = {}
+        self._records = list(records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('JobTable index out of range')
+        return JobRecord(self, index)
+
+    def __iter__(self):
+        return (JobRecord(self, i) for i in range(len(self._records)))
+
+    def __len__(self):
+        return len(self._records)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def column(self, field):
+        """Return values of a field for all records, with None where it is missing."""
+        column = self._columns.get(field)
+        if column is None:
+            key, column = f' {field}=', []
+            for record in self._records:
+                start = record.find(key)
+                if start < 0:
+                    column.append(None)
+                    continue
+                start += len(key)
+                match = _FIELD_END.search(record, start)
+                column.append(record[start:match.start()] if match else record[start:])
+            self._columns[field] = column
+        return column
+
+    def dicts(self):
+        """Return all records as dictionaries, splitting each record in a single pass, which is faster than converting every JobRecord when all fields are needed."""
+        dicts = []
+        for i, record in enumerate(self._records):
+            fields = _FIELD_SPLIT.split(record)
+            keys, values = fields[1::2], fields[2::2]
+            details = dict(zip(keys, values))
+            if len(details) < len(keys):  # keep the first of repeated fields, as JobRecord does
+                details = {}
+                for key, value in zip(keys, values):
+                    details.setdefault(key, value)
+            for field, column in self._columns.items():
+                if column[i] is None:
+                    details.pop(field, None)
+                else:
+                    details[field] = column[i]
+            dicts.append(details)
+        return dicts
+
+    @classmethod
+    def from_scontrol(cls, stdouts):
+        """Parse the output of scontrol show, either one record per line (--oneliner) or in blocks separated by empty lines, sorted by array task ID."""
+        records, record = [], []
+        for stdout in stdouts:
+            if stdout.strip():
+                record.append(stdout)
+            elif record:
+                records.append(' ' + ' '.join(record))
+                record = []
+            if record and stdout.startswith(('JobId=', 'NodeName=', 'PartitionName=')) and len(record) > 1:
+                records.append(' ' + ' '.join(record[:-1]))
+                record = record[-1:]
+        if record:
+            records.append(' ' + ' '.join(record))
+        table = cls(records)
+        tasks = table.column('ArrayTaskId')
+        if any(x is not None for x in tasks):
+            order = sorted(range(len(table)), key=lambda i: int(tasks[i]) if tasks[i] is not None and tasks[i].isnumeric() else 0)
+            table = cls(records[i] for i in order)
+        return table
+
+
+class JobTracker:
+    """Shared state of watched jobs and their array tasks.
+
+    All watched jobs are refreshed with a single squeue query, falling back to sacct for jobs that are no longer queued, and callers are served from a cache for ttl seconds.
+    Jobs are no longer queried once all of their tasks reach a terminal state.
+    """
+
+    def __init__(self, slurm, ttl=5):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.RLock()
+        self._slurm = weakref.ref(slurm)  # avoid a reference cycle that would keep the connection open
+        self._updated = None
+
+    def records(self, job=None, refresh=False):
+        """Return records of a job (watching it if needed) or of all watched jobs, sorted by array task ID."""
+        with self._lock:
+            if job is not None and str(job) not in self._jobs:
+                self.watch(job)
+            if refresh or self._updated is None or time.monotonic() - self._updated > self.ttl:
+                self.refresh()
+            records = self._jobs[str(job)] if job is not None else [x for y in self._jobs.values() for x in y]
+        return sorted(records, key=lambda x: int(x['ArrayTaskId']) if x.get('ArrayTaskId', '').isnumeric() else 0)
+
+    def refresh(self):
+        with self._lock:
+            jobs = [job for job, records in self._jobs.items() if not records or any(x['JobState'] in ACTIVE_STATES for x in records)]
+            if jobs:
+                records = {job: [] for job in jobs}
+                stdouts = self.slurm.ssh.exec_command(f"squeue --jobs={','.join(jobs)} --array --states=all --noheader --format='{SQUEUE_FORMAT}'", error=False)
+                for stdout in stdouts:
+                    fields = stdout.split('|', 8)
+                    if len(fields) == 9:
+                        self._assign(records, dict(zip(('JobId', 'ArrayJobId', 'ArrayTaskId', 'JobState', 'Reason', 'RunTime', 'Partition', 'UserId', 'JobName'), fields)))
+                missing = [job for job, records_ in records.items() if not records_]
+                if missing:
+                    stdouts = self.slurm.ssh.exec_command(f"sacct --jobs={','.join(missing)} --allocations --noheader --parsable2 --format={SACCT_FORMAT}", error=False)
+                    for stdout in stdouts:
+                        fields = stdout.split('|', 6)
+                        if len(fields) == 7:
+                            jobid, arrayjobid, state, elapsed, partition, user, name = fields
+                            arrayjobid, _, arraytaskid = arrayjobid.partition('_')
+                            self._assign(records, {'JobId': jobid, 'ArrayJobId': arrayjobid, 'ArrayTaskId': arraytaskid.strip('[]') or 'N/A', 'JobState': state.split()[0] if state else '', 'Reason': '', 'RunTime': elapsed, 'Partition': partition, 'UserId': user, 'JobName': name})
+                logging.getLogger('ipyslurm.tracker').debug(f'Refreshed {len(jobs)} jobs')
+                self._jobs.update(records)
+            self._updated = time.monotonic()
+
+    @property
+    def slurm(self):
+        return self._slurm()
+
+    def unwatch(self, job):
+        with self._lock:
+            self._jobs.pop(str(job), None)
+
+    def watch(self, job):
+        with self._lock:
+            self._jobs.setdefault(str(job), [])
+            self._updated = None
+
+    def _assign(self, records, record):
+        if record['ArrayTaskId'] == 'N/A':
+            del record['ArrayTaskId']
+        for job in records:
+            if job in (record['JobId'], record['ArrayJobId'], f'{record["ArrayJobId"]}_{record.get("ArrayTaskId")}'):  # noqa: Q000
+                records[job].append(record)
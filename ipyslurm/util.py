@@ -1,6 +1,16 @@
 import re
 
 
+def parse_size(size):
+    """Parse a size in bytes with an optional binary suffix, e.g., 512K, 50M or 1G."""
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)i?B?\s*', size, flags=re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'Invalid size "{size}"')
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+
 def sort_key_natural(s, _nsre=re.compile('([0-9]+)')):
     """Adapted from http://blog.codinghorror.com/sorting-for-humans-natural-sort-order."""
     return [int(text) if text.isdigit() else text.lower() for text in re.split(_nsre, str(s))]
@@ -17,3 +27,29 @@ def split_list(x, separator):
             current.append(item)
     final.append(current)
     return final
+
+
+def parse_argv(argv, options=()):
+    """Split sftp-style arguments into flags, option values, and operands.
+
+    Single letter flags may be combined (e.g., -ra), whereas options take a value (e.g., -j 4, -j4, --limit 10M, --limit=10M).
+    The command name is kept as the first operand.
+    """
+    flags, values, operands = set(), {}, []
+    argv = iter(argv)
+    for arg in argv:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            if name in options:
+                values[name] = value or next(argv, '')
+            else:
+                flags.add(name)
+        elif arg.startswith('-') and len(arg) > 1:
+            for i, name in enumerate(arg[1:]):
+                if name in options:
+                    values[name] = arg[i + 2:] or next(argv, '')
+                    break
+                flags.add(name)
+        else:
+            operands.append(arg)
+    return flags, values, operands